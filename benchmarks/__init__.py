@@ -0,0 +1,4 @@
+# Benchmarks for wiring.py
+#
+#   python -m benchmarks.generate -o harness.yml --connections 10000
+#   python -m benchmarks.run --sizes small,medium,large -o results.json
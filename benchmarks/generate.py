@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+# Generator for synthetic harness YAML files, used by the benchmarks.
+
+import argparse
+import random
+import sys
+
+color_codes = ["WH", "BN", "GN", "YE", "GY", "PK", "BU", "RD", "BK", "VT", "PU", "OR", "TQ", "SL", "GD"]
+
+def generate(devices=100, pins=20, connections=1000, groups=10, colors=8, device_colors=0.5, unconnected=0.05, seed=0):
+    rng = random.Random(seed)
+    palette = color_codes[:max(1, min(colors, len(color_codes)))]
+
+    lines = [
+        f"# Synthetic harness: {devices} devices, {pins} pins, {connections} connections, {groups} groups",
+        "",
+        "devices:",
+    ]
+
+    device_pins = []
+
+    for d in range(devices):
+        name = f"Device {d}"
+        pin_names = [f"P{p}" for p in range(1, pins + 1)]
+        device_pins.append((name, pin_names))
+
+        lines.append(f"  - name: {name}")
+        lines.append(f"    pins: {', '.join(pin_names)}")
+
+        if rng.random() < device_colors:
+            lines.append(f"    colors: {', '.join(rng.choice(palette) for _ in pin_names)}")
+
+    connected = device_pins[:max(2, devices - int(devices * unconnected))]
+
+    lines.append("")
+    lines.append("connections:")
+
+    for c in range(connections):
+        (from_name, from_pins), (to_name, to_pins) = rng.sample(connected, 2)
+
+        lines.append(f"  - from: {from_name}, {rng.choice(from_pins)}")
+        lines.append(f"    to: {to_name}, {rng.choice(to_pins)}")
+        lines.append(f"    color: {rng.choice(palette)}")
+
+        if groups > 1:
+            lines.append(f"    group: group{c % groups}")
+
+    lines.append("")
+
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic harness YAML file')
+    parser.add_argument('-o', '--output', action='store', default='-', help='Output file (default: stdout)')
+    parser.add_argument('--devices', action='store', type=int, default=100, help='Number of devices')
+    parser.add_argument('--pins', action='store', type=int, default=20, help='Pins per device')
+    parser.add_argument('--connections', action='store', type=int, default=1000, help='Number of connections')
+    parser.add_argument('--groups', action='store', type=int, default=10, help='Number of groups')
+    parser.add_argument('--colors', action='store', type=int, default=8, help='Number of different wire colors used')
+    parser.add_argument('--device-colors', action='store', type=float, default=0.5, help='Fraction of devices that list pin colors')
+    parser.add_argument('--unconnected', action='store', type=float, default=0.05, help='Fraction of devices that are not connected')
+    parser.add_argument('--seed', action='store', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    text = generate(args.devices, args.pins, args.connections, args.groups, args.colors, args.device_colors, args.unconnected, args.seed)
+
+    if args.output == '-':
+        sys.stdout.write(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+if __name__ == '__main__':
+    main()
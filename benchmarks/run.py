@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+# Times each phase of wiring.py on synthetic harnesses of increasing size and
+# writes the results as JSON, so that regressions (and the sizes where
+# something starts to grow faster than linearly) can be tracked.
+
+from yaml import load
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wiring
+from benchmarks.generate import generate
+
+# name: (devices, pins per device, connections, groups)
+sizes = {
+    "tiny": (10, 5, 50, 2),
+    "small": (50, 10, 500, 5),
+    "medium": (200, 20, 5000, 20),
+    "large": (1000, 40, 20000, 40),
+    "xlarge": (2000, 100, 100000, 100),
+}
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+def run_phases(text, render):
+    phases = {}
+    counts = {}
+
+    phases["yaml_load"], yaml = timed(lambda: load(text, Loader=wiring.SafeLoader))
+
+    profile = wiring.Profile()
+    phases["doc"], doc = timed(lambda: wiring.Doc(yaml, profile=profile))
+    phases["model"] = profile.phases["model"]
+    phases["validation"] = profile.phases["validation"]
+
+    phases["stream_doc"], _ = timed(lambda: wiring.stream_doc(io.BytesIO(text.encode("utf-8"))))
+
+    report_args = argparse.Namespace(max_warnings=None, diagnostics_json=None)
+    phases["diagnostics"], _ = timed(lambda: wiring.report_diagnostics(doc.diagnostics, report_args, io.StringIO()))
+
+    for device in doc.devices.values():
+        device.table = None
+
+    phases["labels"], _ = timed(lambda: [wiring.create_table(device) for device in doc.devices.values()])
+
+    unused_devices = [device for device in doc.devices.values() if device.connection_count_total == 0]
+
+    def write_sources():
+        sources = []
+
+        for group, connections in doc.groups.items():
+            out = io.StringIO()
+            wiring.write_group_graph(out, doc, group, connections, False)
+            sources.append(out.getvalue())
+
+        if unused_devices:
+            out = io.StringIO()
+            wiring.write_unconnected_graph(out, unused_devices, False)
+            sources.append(out.getvalue())
+
+        return sources
+
+    phases["dot_source"], sources = timed(write_sources)
+
+    if render:
+        with tempfile.TemporaryDirectory() as tmp:
+            def render_all():
+                for i, source in enumerate(sources):
+                    wiring.run_dot(source, os.path.join(tmp, f"{i}.svg"), "svg")
+
+            phases["render"], _ = timed(render_all)
+    else:
+        phases["render"] = None
+
+    counts["devices"] = len(doc.devices)
+    counts["connections"] = sum(len(connections) for connections in doc.groups.values())
+    counts["groups"] = len(doc.groups)
+    counts["diagnostics"] = len(doc.diagnostics)
+    counts["dot_bytes"] = sum(len(source) for source in sources)
+
+    return phases, counts
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the phases of wiring.py on synthetic harnesses')
+    parser.add_argument('--sizes', action='store', default='tiny,small,medium,large', help='Comma separated sizes to run (' + ', '.join(sizes) + ')')
+    parser.add_argument('--repeat', action='store', type=int, default=3, help='Runs per size; the fastest time of each phase is kept')
+    parser.add_argument('--render', action='store_true', help='Also time the Graphviz render (needs dot on the PATH)')
+    parser.add_argument('--seed', action='store', type=int, default=0, help='Random seed for the generated harnesses')
+    parser.add_argument('-o', '--output', action='store', default='-', help='JSON output file (default: stdout)')
+    args = parser.parse_args()
+
+    if args.render and shutil.which("dot") is None:
+        parser.error("--render needs the Graphviz dot executable on the PATH")
+
+    results = []
+
+    for name in args.sizes.split(","):
+        name = name.strip()
+
+        if name not in sizes:
+            parser.error(f"unknown size {name}")
+
+        devices, pins, connections, groups = sizes[name]
+        text = generate(devices, pins, connections, groups, seed=args.seed)
+
+        best = None
+
+        for _ in range(args.repeat):
+            phases, counts = run_phases(text, args.render)
+
+            if best is None:
+                best = phases
+            else:
+                best = {phase: None if t is None else min(t, best[phase]) for phase, t in phases.items()}
+
+        print(f"{name:8s} " + " ".join(f"{phase}={t:.3f}s" for phase, t in best.items() if t is not None), file=sys.stderr)
+
+        results.append({
+            "size": name,
+            "parameters": {"devices": devices, "pins": pins, "connections": connections, "groups": groups, "seed": args.seed},
+            "yaml_bytes": len(text),
+            "phases": best,
+            "counts": counts,
+        })
+
+    data = {
+        "wiring_version": wiring.__version__,
+        "python": platform.python_version(),
+        "yaml_loader": wiring.SafeLoader.__name__,
+        "results": results,
+    }
+
+    text = json.dumps(data, indent=1)
+
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,43 @@
 #!/usr/bin/python3
 
-from graphviz import Graph
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
-from yaml import safe_load
+from yaml import YAMLError
+from yaml.events import AliasEvent, MappingEndEvent, MappingStartEvent, ScalarEvent, SequenceEndEvent, SequenceStartEvent, StreamEndEvent
+from yaml.nodes import MappingNode, ScalarNode, SequenceNode
+from array import array
+from collections import Counter
+from itertools import chain
 import argparse
+import cProfile
+import csv
+import glob
+import hashlib
+import io
+import json
 import os
+import pickle
+import re
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import traceback
+
+try:
+    from yaml import CSafeLoader as SafeLoader # libyaml based, much faster
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    import numpy # optional, speeds up the WireTable statistics
+except ImportError:
+    numpy = None
 
 __version__ = '0.2.2'
 
@@ -30,403 +62,2321 @@ color_list = [
 ]
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        sys.exit(query_main(sys.argv[2:]))
+
     args = parse_args()
 
-    if not os.path.exists(args.input_file):
-        print(f'Error: input file {args.input_file} inaccessible or does not exist, check path')
-        sys.exit(1)
+    if args.cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        if args.watch:
+            status = watch_file(args.input_files[0], args)
+        elif args.diff:
+            status = diff_files(args.input_files[0], args.input_files[1], args)
+        elif len(args.input_files) == 1:
+            status, doc = process_file(args.input_files[0], args)
+        else:
+            status = process_batch(args)
+    except (RuntimeError, subprocess.CalledProcessError) as e:
+        print(f"Error: {e}")
+        status = 1
+    finally:
+        if args.cprofile:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+
+    sys.exit(status)
+
+# Check and render one input file, writing all messages to out. Returns the exit
+# status and the Doc (None if the file couldn't be read). The phase timings and
+# counters are collected in profile and reported if --profile/--profile-json
+# were given.
+def process_file(input_file, args, out=None, profile=None):
+    if out is None:
+        out = sys.stdout
+
+    if profile is None:
+        profile = Profile()
+
+    if not os.path.exists(input_file):
+        print(f'Error: input file {input_file} inaccessible or does not exist, check path', file=out)
+        return 1, None
 
     if args.verbose:
-        print(f'Input file: {args.input_file}')
+        print(f'Input file: {input_file}', file=out)
 
-    output_pre = os.path.splitext(args.input_file)[0]
+    output_pre = os.path.splitext(input_file)[0]
 
     if args.verbose:
-        print(f'Output file: {output_pre}')
+        print(f'Output file: {output_pre}', file=out)
 
-    stream = open(args.input_file, 'r')
+    cache_dir = args.cache_dir or os.path.join(os.path.dirname(input_file), '.wiring-cache')
 
-    if args.verbose:
-        print(f'Parsing YAML file...')
+    doc = load_doc(input_file, cache_dir, args, out, profile)
 
-    yaml = safe_load(stream.read())
+    profile.count("devices", len(doc.devices))
+    profile.count("connections", sum(len(connections) for connections in doc.groups.values()))
+    profile.count("wires", sum(c.wire_count() for connections in doc.groups.values() for c in connections))
+    profile.count("diagnostics", len(doc.diagnostics))
 
     if args.verbose:
-        print("Generating graph...")
+        print(f"Devices: {len(doc.devices)}", file=out)
 
-    doc = Doc(yaml)
+    with profile.phase("diagnostics"):
+        report_diagnostics(doc.diagnostics, args, out)
 
-    if args.verbose:
-        print(f"Devices: {len(doc.devices)}")
+    if args.bom:
+        with profile.phase("bom"):
+            write_bom(args.bom, {input_file: WireTable(doc)}, out)
 
-    for group, connections in doc.groups.items():
-        for connection in connections:
-            if connection.fromDevice not in doc.devices:
-                print(f"Warning: device {connection.fromDevice} not found")
+    if args.check_only:
+        profile.report(args, out)
+        return 1 if doc.diagnostics else 0, doc
+
+    # the device labels are built once and reused by every graph a device is in
+    with profile.phase("labels"):
+        for device in doc.devices.values():
+            create_table(device)
+
+    with profile.phase("graphs"):
+        render_graphs(doc, output_pre, cache_dir, args, out, profile)
+
+    profile.report(args, out)
+
+    return 0, doc
+
+# Render the graphs of doc. If changed is given, only the graphs of those groups
+# (and the combined graph or overview, if anything changed) are rendered.
+def render_graphs(doc, output_pre, cache_dir, args, out, profile, changed=None):
+    renderer = Renderer(args, cache_dir, out, profile)
+    files = {} # map from group to the files its graph (or each of its parts) is rendered to
+
+    for graph in graphs(doc, args.white, args.combine, args.max_nodes, args.max_edges):
+        if graph.name is None:
+            filename = output_pre
+        else:
+            filename = output_pre if graph.name == "default" else output_pre + "_" + graph.name
+
+            if graph.part is not None:
+                filename += "_" + str(graph.part)
+
+        files.setdefault(graph.name, []).append(filename + "." + args.format)
+
+        if changed is not None and graph.name not in changed and not (graph.name is None and changed):
+            continue
+
+        if graph.name is None:
+            renderer.render(graph.write, filename, filename + ".svg")
+        else:
+            # with --overview only the overview is shown, it links to the rest
+            renderer.render(graph.write, filename, filename + ".png" if not args.overview else None)
+
+    if args.overview and (changed is None or changed):
+        filename = output_pre + ".overview" # group graphs are NAME or NAME_group, so this can't clash
+        write = partial(write_overview_graph, doc=doc, files=files, white=args.white)
+        renderer.render(write, filename, filename + "." + args.format)
+
+    renderer.finish()
+
+# Stay resident and check and render input_file again every time it changes. The
+# Doc is kept between edits and updated incrementally, and only the groups that
+# changed are rendered again. A file with an include section is rebuilt from its
+# (cached) parts whenever it or one of the included files changes.
+def watch_file(input_file, args):
+    output_pre = os.path.splitext(input_file)[0]
+    cache_dir = args.cache_dir or os.path.join(os.path.dirname(input_file), '.wiring-cache')
+    state = None
+    stamp = None
+    key = None
+    watched = [input_file] # the input file and the files it includes
+
+    try:
+        while True:
+            new_stamp = tuple(file_stamp(path) for path in watched)
+
+            if new_stamp[0] is None or new_stamp == stamp:
+                time.sleep(args.watch_interval)
                 continue
 
-            if connection.toDevice not in doc.devices:
-                print(f"Warning: device {connection.toDevice} not found")
+            stamp = new_stamp
+
+            with open(input_file, 'rb') as f:
+                data = f.read()
+
+            new_key = hashlib.sha256(data).hexdigest()
+
+            if new_key == key and len(watched) == 1:
                 continue
 
-            if len(connection.fromPins) != len(connection.toPins):
-                if len(connection.fromPins) == 0 and len(doc.devices[connection.fromDevice].pins) != 0:
-                    print(f"Warning: in connection {connection.fromDevice}:{connection.fromPins} -> {connection.toDevice}:{connection.toPins} pin not specified but device {connection.fromDevice} has pins")
-                    continue
+            key = new_key
+            start = time.perf_counter()
 
-                if len(connection.toPins) == 0 and len(doc.devices[connection.toDevice].pins) != 0:
-                    print(f"Warning: in connection {connection.fromDevice}:{connection.fromPins} -> {connection.toDevice}:{connection.toPins} pin not specified but device {connection.toDevice} has pins")
-                    continue
+            try:
+                yaml, lines = load_with_lines(data)
 
-                if len(connection.fromPins) != 0 and len(connection.toPins) != 0:
-                    print(f"Warning: connection {connection.fromDevice}:{connection.fromPins} -> {connection.toDevice}:{connection.toPins} has different number of from/to pins")
-                    continue
+                if type(yaml) == dict and yaml.get("include"):
+                    doc, dependencies = load_project(input_file, yaml, cache_dir, args, sys.stdout, lines)
+                    watched = [input_file] + list(dependencies)
+                    stamp = tuple(file_stamp(path) for path in watched)
+                    state = None
+                    changed = None
+                else:
+                    if state is None:
+                        state = IncrementalDoc(yaml)
+                        changed = None
+                    else:
+                        changed = state.update(yaml)
 
-            if len(connection.colors) != max(len(connection.fromPins), len(connection.toPins), 1):
-                print(f"Warning: connection {connection.fromDevice}:{connection.fromPins} -> {connection.toDevice}:{connection.toPins} has different number of colors and pins")
+                    doc = state.doc
+                    watched = [input_file]
+            except (YAMLError, AssertionError, AttributeError, KeyError, TypeError) as e:
+                print(f"Error: {input_file}: {type(e).__name__}: {e}")
                 continue
 
-            for pin in connection.fromPins:
-                if pin not in doc.devices[connection.fromDevice].pins:
-                    print(f"Warning: pin {pin} not found in device {connection.fromDevice}")
-                    continue
+            if changed is None:
+                print(f"Loaded {input_file}")
+            else:
+                print(f"Changed: {', '.join(sorted(changed)) or 'nothing to render'}")
 
-            for pin in connection.toPins:
-                if pin not in doc.devices[connection.toDevice].pins:
-                    print(f"Warning: pin {pin} not found in device {connection.toDevice}")
-                    continue
+            report_diagnostics(doc.diagnostics, args, sys.stdout)
 
-            if doc.devices[connection.fromDevice].colors:
-                # TODO This should happen somewhere else
-                if len(doc.devices[connection.fromDevice].pins) != len(doc.devices[connection.fromDevice].colors):
-                    print(f"Warning: device {connection.fromDevice} has different number of pins and colors")
-                    continue
+            if not args.check_only:
+                try:
+                    render_graphs(doc, output_pre, cache_dir, args, sys.stdout, Profile(), changed)
+                except (RuntimeError, subprocess.CalledProcessError) as e:
+                    print(f"Error: {e}")
 
-                for i in range(len(connection.colors)):
-                    pinName = connection.fromPins[i]
-                    j = 0
-                    for j in range(len(doc.devices[connection.fromDevice].pins)):
-                        if doc.devices[connection.fromDevice].pins[j] == pinName:
-                            break
-
-                    if get_color(doc.devices[connection.fromDevice].colors[j]) != get_color(connection.colors[i]):
-                        print(f"Warning: in connection {connection.fromDevice}:{connection.fromPins} -> {connection.toDevice}:{connection.toPins} color {connection.colors[i]} doesn't match device {connection.fromDevice} color {doc.devices[connection.fromDevice].colors[j]}")
-                        continue
-
-            if doc.devices[connection.toDevice].colors:
-                # TODO This should happen somewhere else
-                if len(doc.devices[connection.toDevice].pins) != len(doc.devices[connection.toDevice].colors):
-                    print(f"Warning: device {connection.toDevice} has different number of pins and colors")
-                    continue
+            args.show = False # image viewers reload the files themselves
+
+            print(f"Done in {time.perf_counter() - start:.2f}s, watching {input_file} (Ctrl+C to stop)")
+    except KeyboardInterrupt:
+        return 0
+
+# (modification time, size) of a file, None if it doesn't exist
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
+
+# Compare two versions of a harness and render a graph of just the differences:
+# the added, removed and recoloured wires, and the devices they connect.
+def diff_files(old_file, new_file, args):
+    for input_file in (old_file, new_file):
+        if not os.path.exists(input_file):
+            print(f'Error: input file {input_file} inaccessible or does not exist, check path')
+            return 1
+
+    docs = []
+
+    for input_file in (old_file, new_file):
+        cache_dir = args.cache_dir or os.path.join(os.path.dirname(input_file), '.wiring-cache')
+        docs.append(load_doc(input_file, cache_dir, args, sys.stdout, Profile()))
+
+    diff = DocDiff(*docs)
+
+    for name, change in diff.devices.items():
+        print(f"Device {change}: {name}")
+
+    for kind in ("added", "removed", "recoloured"):
+        for tail, head, old_color, new_color in diff.wires[kind]:
+            colors = f"{old_color} -> {new_color}" if kind == "recoloured" else old_color or new_color
+            print(f"Wire {kind}: {format_endpoint(tail)} -- {format_endpoint(head)} ({colors})")
+
+    print(f"{len(diff.wires['added'])} added, {len(diff.wires['removed'])} removed, {len(diff.wires['recoloured'])} recoloured wires, {len(diff.devices)} changed devices")
+
+    if args.check_only or diff.empty():
+        return 0
+
+    output = os.path.splitext(new_file)[0] + "_diff"
+    cache_dir = args.cache_dir or os.path.join(os.path.dirname(new_file), '.wiring-cache')
+    renderer = Renderer(args, cache_dir, sys.stdout, Profile())
+    renderer.render(partial(write_diff_graph, diff=diff, white=args.white), output, output + "." + args.format)
+    renderer.finish()
+
+    return 0
+
+# The differences between two Docs. Devices are matched by name and wires by
+# their two (device, pin) endpoints (pin None for a pin-less end), regardless of
+# which end is "from". Parallel wires between the same endpoints are matched by
+# color first; the ones left over are recoloured, added or removed. Wires keep
+# the direction they are written in (the new one for recoloured wires), which is
+# the direction they are drawn in.
+class DocDiff:
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        self.devices = {} # map from device name to "added", "removed" or "changed"
+
+        for name in old.devices.keys() | new.devices.keys():
+            a = old.devices.get(name)
+            b = new.devices.get(name)
+
+            if a is None:
+                self.devices[name] = "added"
+            elif b is None:
+                self.devices[name] = "removed"
+            elif (a.pins, a.colors, a.info, a.unused) != (b.pins, b.colors, b.info, b.unused):
+                self.devices[name] = "changed"
+
+        self.devices = dict(sorted(self.devices.items()))
+
+        old_wires = self.wires_of(old)
+        new_wires = self.wires_of(new)
+
+        self.wires = {"added": [], "removed": [], "recoloured": []} # lists of (tail, head, old color, new color)
+
+        for key in old_wires.keys() | new_wires.keys():
+            old_left = [] # old wires without a new wire of the same color
+            new_left = list(new_wires.get(key, []))
+
+            for wire in old_wires.get(key, []):
+                match = next((other for other in new_left if other[0] == wire[0]), None)
+
+                if match is None:
+                    old_left.append(wire)
+                else:
+                    new_left.remove(match)
+
+            for (old_color, _, _), (new_color, tail, head) in zip(old_left, new_left):
+                self.wires["recoloured"].append((tail, head, old_color, new_color))
+
+            for old_color, tail, head in old_left[len(new_left):]:
+                self.wires["removed"].append((tail, head, old_color, None))
+
+            for new_color, tail, head in new_left[len(old_left):]:
+                self.wires["added"].append((tail, head, None, new_color))
+
+        for wires in self.wires.values():
+            wires.sort(key=lambda wire: [(name, pin or "") for name, pin in self.wire_key(wire[0], wire[1])])
+
+    # The endpoints of a wire in a fixed order, for matching wires written in either direction
+    @staticmethod
+    def wire_key(tail, head):
+        a = (tail[0], tail[1] or "")
+        b = (head[0], head[1] or "")
+
+        return (tail, head) if a <= b else (head, tail)
 
-                for i in range(len(connection.colors)):
-                    pinName = connection.toPins[i]
-                    j = 0
-                    for j in range(len(doc.devices[connection.toDevice].pins)):
-                        if doc.devices[connection.toDevice].pins[j] == pinName:
-                            break
+    # Map from wire_key() to the (color, tail, head) of the wires between those endpoints
+    @staticmethod
+    def wires_of(doc):
+        wires = {}
 
-                    if get_color(doc.devices[connection.toDevice].colors[j]) != get_color(connection.colors[i]):
-                        print(f"Warning: in connection {connection.fromDevice}:{connection.fromPins} -> {connection.toDevice}:{connection.toPins} color {connection.colors[i]} doesn't match device {connection.toDevice} color {doc.devices[connection.toDevice].colors[j]}")
-                        continue
+        for connections in doc.groups.values():
+            for c in connections:
+                fromPins = [str(pin) for pin in c.fromPins] or [None] * max(len(c.toPins), 1)
+                toPins = [str(pin) for pin in c.toPins] or [None] * len(fromPins)
 
-    def create_table(device):
-        is_node = len(device.pins) == 0
+                for i, (fromPin, toPin) in enumerate(zip(fromPins, toPins)):
+                    color = doc.color_registry.code(str(c.colors[i])) if i < len(c.colors) else ""
+                    tail = (c.fromDevice, fromPin)
+                    head = (c.toDevice, toPin)
+                    wires.setdefault(DocDiff.wire_key(tail, head), []).append((color, tail, head))
 
-        table = '<<table border="1" cellspacing="0" cellpadding="2">'
+        return wires
 
-        if is_node:
-            table += f'<tr><td colspan="3" bgcolor="{title_color}">{device.name} ({device.connection_count_total})</td></tr>'
+    def empty(self):
+        return not self.devices and not any(self.wires.values())
+
+# In-memory API, for using this script as a module without touching the
+# filesystem:
+#
+#     import wiring
+#     doc = wiring.parse(open("harness.yml").read())
+#     diagnostics = doc.validate()
+#     for graph in wiring.graphs(doc):
+#         png = graph.render("png")
+#
+# Everything a call needs hangs off its Doc, so different threads can parse and
+# render at the same time.
+
+# Build a Doc from YAML text (str or bytes) or from an already loaded dict
+def parse(source):
+    lines = None
+
+    if isinstance(source, (str, bytes)):
+        source, lines = load_with_lines(source)
+
+    return Doc(source, lines)
+
+# The graphs the command line would render for doc: one per group plus one for
+# the unconnected devices, or a single combined graph (named None). A graph with
+# more than max_nodes devices or max_edges wires is split into parts (numbered
+# from 1) that are laid out separately; a combined graph that is too big falls
+# back to one graph per group.
+def graphs(doc, white=False, combine=False, max_nodes=None, max_edges=None):
+    unused_devices = [device for device in doc.devices.values() if device.connection_count_total == 0]
+
+    if combine:
+        connections = [c for group_connections in doc.groups.values() for c in group_connections]
+
+        if not over_limit(connection_devices(connections), connections, max_nodes, max_edges, len(unused_devices)):
+            return [Graph(None, partial(write_combined_graph, doc=doc, unused_devices=unused_devices, white=white))]
+
+    result = []
+
+    for group, connections in doc.groups.items():
+        parts = partition_connections(connections, max_nodes, max_edges)
+
+        if len(parts) == 1:
+            result.append(Graph(group, partial(write_group_graph, doc=doc, group=group, connections=connections, white=white)))
+            continue
+
+        part_devices = [connection_devices(part) for part in parts]
+
+        for k, part in enumerate(parts):
+            label = f"{group} ({k + 1}/{len(parts)})" if group != "default" else f"({k + 1}/{len(parts)})"
+
+            # Devices that are also drawn in other parts get a stub pointing to them
+            stubs = {}
+
+            for device in part_devices[k]:
+                others = [str(j + 1) for j, devices in enumerate(part_devices) if j != k and device in devices]
+
+                if others:
+                    stubs[device] = "continued in part " + ", ".join(others)
+
+            write = partial(write_group_graph, doc=doc, group=group, connections=part, white=white, label=label, stubs=stubs)
+            result.append(Graph(group, write, k + 1))
+
+    if len(unused_devices) > 0:
+        size = max_nodes if max_nodes else len(unused_devices)
+        chunks = [unused_devices[i:i + size] for i in range(0, len(unused_devices), size)]
+
+        for k, chunk in enumerate(chunks):
+            write = partial(write_unconnected_graph, devices=chunk, white=white)
+            result.append(Graph("Unconnected", write, k + 1 if len(chunks) > 1 else None))
+
+    return result
+
+def connection_devices(connections):
+    devices = {}
+
+    for connection in connections:
+        devices[connection.fromDevice] = None
+        devices[connection.toDevice] = None
+
+    return devices.keys()
+
+def over_limit(devices, connections, max_nodes, max_edges, extra_nodes=0):
+    if max_nodes and len(devices) + extra_nodes > max_nodes:
+        return True
+
+    return bool(max_edges) and sum(c.wire_count() for c in connections) > max_edges
+
+# Split the connections of a group into parts of at most max_nodes devices and
+# max_edges wires. Connected components are kept together where they fit (small
+# ones are packed into the same part); a component that doesn't fit is cut into
+# pieces in breadth first order, so devices that are wired together tend to end
+# up in the same part. A single connection is never split.
+def partition_connections(connections, max_nodes, max_edges):
+    if not over_limit(connection_devices(connections), connections, max_nodes, max_edges):
+        return [connections]
+
+    parent = {}
+
+    def find(device):
+        while parent.setdefault(device, device) != device:
+            parent[device] = parent[parent[device]]
+            device = parent[device]
+
+        return device
+
+    for connection in connections:
+        parent[find(connection.fromDevice)] = find(connection.toDevice)
+
+    components = {}
+
+    for connection in connections:
+        components.setdefault(find(connection.fromDevice), []).append(connection)
+
+    parts = []
+    current = Part(max_nodes, max_edges)
+
+    for component in components.values():
+        if over_limit(connection_devices(component), component, max_nodes, max_edges):
+            pieces = split_component(component, max_nodes, max_edges)
         else:
-            table += f'<tr><td colspan="3" bgcolor="{title_color}">{device.name}</td></tr>'
+            pieces = [component]
 
-        if device.info:
-            table += f'<tr><td colspan="3">{device.info}</td></tr>'
+        for piece in pieces:
+            if current.connections and not current.fits(piece):
+                parts.append(current.connections)
+                current = Part(max_nodes, max_edges)
 
-        fmt = '<tr><td port="{1}w" bgcolor="{3}">{0}</td><td bgcolor="{3}">{1}</td><td port="{1}e" bgcolor="{3}">{2}</td></tr>'
+            current.add(piece)
 
-        for i in range(len(device.pins)):
-            pin_name = device.pins[i]
+    parts.append(current.connections)
 
-            if pin_name is None:
-                table += f'<tr><td>{i + 1}</td><td></td><td></td></tr>'
+    return parts
+
+def split_component(connections, max_nodes, max_edges):
+    adjacent = {} # map from device name to its connections
+
+    for connection in connections:
+        adjacent.setdefault(connection.fromDevice, []).append(connection)
+        adjacent.setdefault(connection.toDevice, []).append(connection)
+
+    parts = []
+    current = Part(max_nodes, max_edges)
+    visited = set() # ids of connections already placed
+    queue = deque([connections[0].fromDevice])
+    queued = {connections[0].fromDevice}
+
+    while queue:
+        device = queue.popleft()
+
+        for connection in adjacent[device]:
+            if id(connection) in visited:
+                continue
+
+            visited.add(id(connection))
+
+            if current.connections and not current.fits([connection]):
+                parts.append(current.connections)
+                current = Part(max_nodes, max_edges)
+
+            current.add([connection])
+
+            for other in (connection.fromDevice, connection.toDevice):
+                if other not in queued:
+                    queued.add(other)
+                    queue.append(other)
+
+    parts.append(current.connections)
+
+    return parts
+
+# A partition being filled by partition_connections()
+class Part:
+    def __init__(self, max_nodes, max_edges):
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges
+        self.connections = []
+        self.devices = set()
+        self.edges = 0
+
+    def fits(self, connections):
+        devices = self.devices.union(connection_devices(connections))
+        edges = self.edges + sum(c.wire_count() for c in connections)
+
+        return not ((self.max_nodes and len(devices) > self.max_nodes) or (self.max_edges and edges > self.max_edges))
+
+    def add(self, connections):
+        self.connections.extend(connections)
+        self.devices.update(connection_devices(connections))
+        self.edges += sum(c.wire_count() for c in connections)
+
+class Graph:
+    def __init__(self, name, write, part=None):
+        self.name = name
+        self.write = write # write(out) writes the DOT source to a text stream and returns its DotWriter
+        self.part = part # number of this part if the group was split, otherwise None
+
+    def source(self):
+        out = io.StringIO()
+        self.write(out)
+        return out.getvalue()
+
+    def render(self, format="png"):
+        return render_bytes(self.source(), format)
+
+# Render DOT source with dot -T<format> through pipes and return the output
+def render_bytes(source, format="png"):
+    if format == "dot":
+        return source.encode("utf-8")
+
+    process = start_dot(["-T" + format], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = process.communicate(source.encode("utf-8"))
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args, output, errors)
+
+    return output
+
+# Process several input files on a pool of args.jobs threads, print each file's
+# output in order once it is done, and finish with a summary. With
+# --diagnostics-json/--profile-json/--bom the results of all files are written
+# to one file, keyed by file name. Returns the exit status: 1 if any file failed.
+def process_batch(args):
+    file_args = argparse.Namespace(**vars(args))
+    file_args.jobs = 1 # the files are already processed in parallel
+    file_args.diagnostics_json = None
+    file_args.profile_json = None
+    file_args.bom = None
+    diagnostics = {}
+    profiles = {}
+    tables = {}
+
+    def run(input_file):
+        out = io.StringIO()
+        start = time.perf_counter()
+        error = None
+        profiles[input_file] = Profile()
+
+        try:
+            status, doc = process_file(input_file, file_args, out, profiles[input_file])
+        except Exception as e:
+            status, doc = 1, None
+            error = f"{type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''}"
+            traceback.print_exc(file=out)
+
+        if doc is not None:
+            diagnostics[input_file] = [d.to_dict() for d in doc.diagnostics]
+
+            if args.bom:
+                tables[input_file] = WireTable(doc)
+
+        warnings = len(doc.diagnostics) if doc is not None else 0
+
+        return input_file, time.perf_counter() - start, warnings, status, error, out.getvalue()
+
+    start = time.perf_counter()
+    results = []
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for result in pool.map(run, args.input_files):
+            output = result[5]
+
+            if output:
+                print(f"==> {result[0]} <==")
+                sys.stdout.write(output)
+
+            results.append(result)
+
+    failed = 0
+
+    print("Summary:")
+
+    for input_file, elapsed, warnings, status, error, output in results:
+        if status != 0:
+            failed += 1
+
+        state = "ok" if status == 0 else "FAILED"
+        line = f"  {elapsed:8.2f}s {warnings:6d} warnings  {state:6s}  {input_file}"
+
+        if error:
+            line += f" ({error})"
+
+        print(line)
+
+    print(f"{len(results)} files, {failed} failed, {time.perf_counter() - start:.2f}s total")
+
+    if args.diagnostics_json:
+        data = json.dumps({input_file: diagnostics.get(input_file, []) for input_file in args.input_files}, indent=1)
+
+        if args.diagnostics_json == "-":
+            print(data)
+        else:
+            with open(args.diagnostics_json, 'w') as f:
+                f.write(data + "\n")
+
+    if args.profile_json:
+        write_json(args.profile_json, {input_file: profiles[input_file].to_dict() for input_file in args.input_files}, sys.stdout)
+
+    if args.bom:
+        write_bom(args.bom, {input_file: tables[input_file] for input_file in args.input_files if input_file in tables}, sys.stdout)
+
+    return 1 if failed else 0
+
+def write_json(path, data, out):
+    text = json.dumps(data, indent=1)
+
+    if path == "-":
+        print(text, file=out)
+    else:
+        with open(path, 'w') as f:
+            f.write(text + "\n")
+
+# Phase timers and counters for --profile
+class Profile:
+    def __init__(self):
+        self.phases = {} # map from phase name to seconds, in the order they ran
+        self.counters = {}
+        self.graphs = {} # map from output file to its DOT size, node/edge count and render time
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def graph(self, output, writer):
+        self.graphs[output] = {"dot_bytes": writer.bytes, "nodes": writer.nodes, "edges": writer.edges, "render_seconds": None, "cached": False}
+        self.count("nodes", writer.nodes)
+        self.count("edges", writer.edges)
+        self.count("dot_bytes", writer.bytes)
+
+    def rendered(self, output, seconds, cached=False, batch=1):
+        self.graphs[output]["render_seconds"] = seconds
+        self.graphs[output]["cached"] = cached
+
+        if batch > 1:
+            self.graphs[output]["batch"] = batch
+
+    def to_dict(self):
+        return {"phases": self.phases, "counters": self.counters, "graphs": self.graphs}
+
+    def report(self, args, out):
+        if args.profile_json:
+            write_json(args.profile_json, self.to_dict(), out)
+
+        if not args.profile:
+            return
+
+        print("Profile:", file=out)
+
+        for name, seconds in self.phases.items():
+            print(f"  {name:20s} {seconds:10.4f}s", file=out)
+
+        print("  " + ", ".join(f"{name} {value}" for name, value in self.counters.items()), file=out)
+
+        if self.graphs:
+            print(f"  {'bytes':>10s} {'nodes':>7s} {'edges':>7s} {'render':>10s}  graph", file=out)
+
+        for output, graph in self.graphs.items():
+            if graph["cached"]:
+                render = "cached"
+            elif graph["render_seconds"] is None:
+                render = "-"
             else:
-                number_of_connections = device.connection_count[pin_name]
+                render = f"{graph['render_seconds']:.4f}s"
 
-                bgcolor = "white"
+                if "batch" in graph:
+                    render += f" (batch of {graph['batch']})"
 
-                if number_of_connections != 1:
-                    bgcolor = "pink"
+            print(f"  {graph['dot_bytes']:10d} {graph['nodes']:7d} {graph['edges']:7d} {render:>10s}  {output}", file=out)
 
-                if pin_name in device.unused:
-                    bgcolor = "lightgrey"
+def write_group_graph(out, doc, group, connections, white, label=None, stubs=None):
+    writer = DotWriter(out)
+    start_graph(writer, white)
+    write_group(writer, doc, group, connections, label, stubs)
+    writer.close()
 
-                if device.colors and i < len(device.colors) and device.colors[i]:
-                    table += fmt.format(i + 1, pin_name, device.colors[i], bgcolor)
-                else:
-                    table += fmt.format(i + 1, pin_name, '', bgcolor)
+    return writer
 
-        table += '</table>>'
+def write_unconnected_graph(out, devices, white):
+    writer = DotWriter(out)
+    start_graph(writer, white)
+    write_unconnected(writer, devices)
+    writer.close()
 
-        return table
+    return writer
 
-    if args.combine:
-        dot = Graph()
+# Every group, and the unconnected devices, as clusters of one graph
+def write_combined_graph(out, doc, unused_devices, white):
+    writer = DotWriter(out)
+    start_graph(writer, white)
 
     for group, connections in doc.groups.items():
-        if not args.combine:
-            dot = Graph()
-
-        font = "Roboto"
-
-        # graph.body.append(f'// Graph generated by APP_NAME {__version__}\n')
-        # graph.body.append(f'// APP_URL\n')
-        dot.attr('graph',
-            rankdir='LR',
-            # ranksep='3',
-            ranksep='2',
-            bgcolor="#FFFFFF" if args.white else "#CCCCCC",
-            nodesep='0.33',
-            fontname=font)
-        dot.attr('node',
-            shape='box',
-            width='0', height='0', margin='0',  # Actual size of the node is entirely determined by the label.
-            style='filled',
-            fillcolor='#F0F0F0',
-            fontname=font)
-        dot.attr('edge',
-            style='bold',
-            fontname=font)
-
-        # dot.attr(splines='polyline')
-
-        groupName = 'cluster_' + group
-
-        with dot.subgraph(name=groupName) as sg:
-            sg.graph_attr['label'] = group if group != "default" else ""
-            for connection in connections:
-                fromDevice = doc.devices[connection.fromDevice]
-                toDevice = doc.devices[connection.toDevice]
+        write_group(writer, doc, group, connections)
 
-                nodeA = group + "_" + fromDevice.name
-                nodeB = group + "_" + toDevice.name
+    if len(unused_devices) > 0:
+        write_unconnected(writer, unused_devices)
+
+    writer.close()
+
+    return writer
+
+def start_graph(writer, white):
+    font = "Roboto"
+
+    # graph.body.append(f'// Graph generated by APP_NAME {__version__}\n')
+    # graph.body.append(f'// APP_URL\n')
+    writer.open("graph")
+    writer.attr('graph',
+        rankdir='LR',
+        # ranksep='3',
+        ranksep='2',
+        bgcolor="#FFFFFF" if white else "#CCCCCC",
+        nodesep='0.33',
+        fontname=font)
+    writer.attr('node',
+        shape='box',
+        width='0', height='0', margin='0',  # Actual size of the node is entirely determined by the label.
+        style='filled',
+        fillcolor='#F0F0F0',
+        fontname=font)
+    writer.attr('edge',
+        style='bold',
+        fontname=font)
+
+    # writer.attr('graph', splines='polyline')
+
+# stubs maps device names to a note about where else the device is drawn (for
+# groups split into parts)
+def write_group(writer, doc, group, connections, label=None, stubs=None):
+    if label is None:
+        label = group if group != "default" else ""
+
+    writer.open("subgraph", 'cluster_' + group)
+    writer.attr('graph', label=label)
+
+    emitted = set() # nodes already in this subgraph
+
+    for connection in connections:
+        fromDevice = doc.devices[connection.fromDevice]
+        toDevice = doc.devices[connection.toDevice]
+
+        nodeA = group + "_" + fromDevice.name
+        nodeB = group + "_" + toDevice.name
+
+        if nodeA not in emitted:
+            writer.node(nodeA, label=create_table(fromDevice), shape='plaintext')
+            emitted.add(nodeA)
+
+        if nodeB not in emitted:
+            writer.node(nodeB, label=create_table(toDevice), shape='plaintext')
+            emitted.add(nodeB)
+
+        r = max(len(connection.fromPins), len(connection.toPins), 1)
+
+        for i in range(r):
+            if connection.fromPins:
+                a = (nodeA, f"{connection.fromPins[i]}e", "e")
+            else:
+                a = (nodeA, None, "e")
 
-                sg.node(nodeA, label=create_table(fromDevice), shape='plaintext')
-                sg.node(nodeB, label=create_table(toDevice), shape='plaintext')
+            if connection.toPins:
+                b = (nodeB, f"{connection.toPins[i]}w", "w")
+            else:
+                b = (nodeB, None, "w")
 
-                r = max(len(connection.fromPins), len(connection.toPins), 1)
+            writer.edge(a, b, color=doc.color_registry.edge(connection.colors[i]), penwidth="2")
 
-                for i in range(r):
-                    if connection.fromPins:
-                        a = f"{nodeA}:{connection.fromPins[i]}e:e"
-                    else:
-                        a = f"{nodeA}:e"
+    if stubs:
+        for name, note in stubs.items():
+            node = group + "_" + name
+            writer.node(node + "_stub", label=note, shape='note', style='dashed')
+            writer.edge((node, None, "s"), (node + "_stub", None, "n"), style='dashed')
 
-                    if connection.toPins:
-                        b = f"{nodeB}:{connection.toPins[i]}w:w"
-                    else:
-                        b = f"{nodeB}:w"
+    writer.close()
 
-                    hex_color = '#000000:' + get_color(connection.colors[i]) + ':#000000'
+def write_unconnected(writer, devices):
+    group = "Unconnected"
 
-                    dot.edge(a, b, color=hex_color, penwidth="2")
+    writer.open("subgraph", 'cluster_' + group)
+    writer.attr('graph', label=group)
 
-        dot.format = args.format
+    for device in devices:
+        node = group + "_" + device.name
+        writer.node(node, label=create_table(device), shape='plaintext')
 
-        filename = output_pre if args.combine or group == "default" else output_pre + "_" + group
+    writer.close()
 
-        filename.replace(" ", "_")
+# One node per group (and one for the unconnected devices), linked to the file
+# with that group's graph, and an edge between every two groups that share
+# devices, labelled with how many. A group split into parts links to each part
+# from a row of cells. Only useful with -f svg (or another format that keeps
+# links).
+def write_overview_graph(out, doc, files, white):
+    writer = DotWriter(out)
+    start_graph(writer, white)
 
-        if not args.combine:
-            if args.verbose:
-                print("Creating " + filename + "." + args.format)
+    groups = {} # map from device name to the groups it is in
 
-            dot.render(filename=filename, view=False, cleanup=True)
+    for group, connections in doc.groups.items():
+        devices = connection_devices(connections)
 
-            if args.show:
-                os.system("eom -n \"" + filename + ".png\" &")
+        for device in devices:
+            groups.setdefault(device, []).append(group)
 
-    unused_devices = []
+        wires = sum(c.wire_count() for c in connections)
+        overview_node(writer, group, f"{len(devices)} devices, {wires} wires", files[group])
 
-    # Create a graph of unused devices
-    for device in doc.devices.values():
-        if device.connection_count_total == 0:
-            unused_devices.append(device)
+    unused_devices = [device for device in doc.devices.values() if device.connection_count_total == 0]
 
     if len(unused_devices) > 0:
-        if not args.combine:
-            dot = Graph()
+        overview_node(writer, "Unconnected", f"{len(unused_devices)} devices", files["Unconnected"], style="filled,dashed")
+
+    shared = {} # map from (group, group) to the devices they share
+
+    for device, device_groups in groups.items():
+        for i, a in enumerate(device_groups):
+            for b in device_groups[i + 1:]:
+                shared.setdefault((a, b), []).append(device)
+
+    for (a, b), devices in shared.items():
+        tooltip = ", ".join(devices[:10]) + (f" and {len(devices) - 10} more" if len(devices) > 10 else "")
+        writer.edge(("overview_" + a, None, "_"), ("overview_" + b, None, "_"), label=str(len(devices)), tooltip=tooltip, penwidth=str(min(1 + len(devices), 8)))
+
+    writer.close()
+
+    return writer
+
+# The overview node of a group: a link to its file, or one cell per part if it
+# was split
+def overview_node(writer, group, summary, files, **attrs):
+    if len(files) == 1:
+        writer.node("overview_" + group, label=f"{group}\\n{summary}", URL=os.path.basename(files[0]), tooltip=f"Open {group}", margin="0.15", **attrs)
+        return
+
+    cells = "".join(f'<td href="{os.path.basename(file)}" tooltip="Open {group} part {k + 1}">{k + 1}/{len(files)}</td>' for k, file in enumerate(files))
+    label = f'<<table border="0" cellborder="1" cellspacing="0" cellpadding="4"><tr><td colspan="{len(files)}">{group}<br/>{summary}</td></tr><tr>{cells}</tr></table>>'
+    writer.node("overview_" + group, label=label, shape="plaintext")
+
+diff_outlines = {"added": "#00a000", "removed": "#e00000", "recoloured": "#ff8c00"}
+
+# Changed wires are drawn in their (new) color with an outline showing the kind
+# of change (removed wires are also dashed). Each device they touch is drawn
+# once, in a cluster for how the device itself changed; removed devices come
+# from the old Doc and all others from the new one.
+def write_diff_graph(out, diff, white):
+    writer = DotWriter(out)
+    start_graph(writer, white)
+
+    touched = {}
+
+    for wires in diff.wires.values():
+        for tail, head, old_color, new_color in wires:
+            touched[tail[0]] = None
+            touched[head[0]] = None
+
+    for name in diff.devices:
+        touched[name] = None
+
+    by_change = {}
+
+    for name in touched:
+        by_change.setdefault(diff.devices.get(name, "unchanged"), []).append(name)
+
+    for change in ("added", "removed", "changed", "unchanged"):
+        if change not in by_change:
+            continue
+
+        writer.open("subgraph", "cluster_" + change)
+        writer.attr('graph', label=change.capitalize() + " devices" if change != "unchanged" else "")
+
+        for name in by_change[change]:
+            doc = diff.old if change == "removed" else diff.new
+            writer.node("diff_" + name, label=create_table(doc.devices[name]), shape='plaintext')
+
+        writer.close()
+
+    for kind, wires in diff.wires.items():
+        for tail, head, old_color, new_color in wires:
+            doc = diff.old if kind == "removed" else diff.new
+            outline = diff_outlines[kind]
+            color = f"{outline}:{doc.color_registry.get(new_color or old_color)}:{outline}"
+            attrs = {"color": color, "penwidth": "3"}
+
+            if kind == "removed":
+                attrs["style"] = "dashed"
+            elif kind == "recoloured":
+                attrs["label"] = f"{old_color} -> {new_color}"
+
+            writer.edge(diff_endpoint(diff, tail, "e"), diff_endpoint(diff, head, "w"), **attrs)
+
+    writer.close()
+
+    return writer
+
+# An edge end for write_diff_graph(), without a port if the pin isn't in the table drawn for the device
+def diff_endpoint(diff, endpoint, side):
+    name, pin = endpoint
+    device = diff.new.devices.get(name) if diff.devices.get(name) != "removed" else diff.old.devices[name]
+
+    if pin is None or pin not in device.pin_index:
+        return ("diff_" + name, None, side)
+
+    return ("diff_" + name, f"{pin}{side}", side)
+
+dot_keywords = {"node", "edge", "graph", "digraph", "subgraph", "strict"}
+dot_plain_id = re.compile(r'^([a-zA-Z_\x80-\U0010FFFF][a-zA-Z0-9_\x80-\U0010FFFF]*|-?(\.[0-9]+|[0-9]+(\.[0-9]*)?))$')
+
+# Quote a DOT identifier or attribute value (the same way the graphviz package does)
+def dot_id(value):
+    value = str(value)
+
+    if value.startswith("<") and value.endswith(">"): # HTML-like label
+        return value
+
+    if dot_plain_id.match(value) and value.lower() not in dot_keywords:
+        return value
+
+    return '"' + re.sub(r'(?<!\\)"', '\\"', value) + '"'
+
+# Writes DOT statements straight to a text stream (a file, a buffer or the stdin
+# of a dot process) instead of building the graph in memory first.
+class DotWriter:
+    def __init__(self, out):
+        self.out = out
+        self.indent = ""
+        self.nodes = 0
+        self.edges = 0
+        self.bytes = 0 # characters written
+
+    def write(self, text):
+        self.out.write(text)
+        self.bytes += len(text)
+
+    def open(self, keyword, name=None):
+        if name is None:
+            self.write(f"{self.indent}{keyword} {{\n")
+        else:
+            self.write(f"{self.indent}{keyword} {dot_id(name)} {{\n")
+
+        self.indent += "\t"
+
+    def close(self):
+        self.indent = self.indent[:-1]
+        self.write(f"{self.indent}}}\n")
+
+    def attr(self, kind, **attrs):
+        self.write(f"{self.indent}{kind} [{dot_attrs(attrs)}]\n")
+
+    def node(self, name, **attrs):
+        self.write(f"{self.indent}{dot_id(name)} [{dot_attrs(attrs)}]\n")
+        self.nodes += 1
+
+    # tail and head are (node, port, compass point) tuples; port may be None
+    def edge(self, tail, head, **attrs):
+        self.write(f"{self.indent}{dot_endpoint(tail)} -- {dot_endpoint(head)} [{dot_attrs(attrs)}]\n")
+        self.edges += 1
+
+def dot_attrs(attrs):
+    return " ".join(f"{key}={dot_id(value)}" for key, value in attrs.items())
+
+def dot_endpoint(endpoint):
+    node, port, compass = endpoint
+
+    if port is None:
+        return f"{dot_id(node)}:{compass}"
+
+    return f"{dot_id(node)}:{dot_id(port)}:{compass}"
+
+# Open the output file for a graph: the file itself for the dot format, otherwise
+# the stdin of a dot process that writes the file. If dot exits before it has
+# read everything (a bad format, a Graphviz error), writing fails with a broken
+# pipe; that is reported as dot's failure, with its messages. dot's messages go
+# to a temporary file rather than a pipe, so that many warnings can't block it
+# while it is being written to.
+@contextmanager
+def dot_output(output, format):
+    if format == "dot":
+        with open(output, 'w', encoding='utf-8') as f:
+            yield f
+
+        return
+
+    errors = tempfile.TemporaryFile()
+    process = start_dot(["-T" + format, "-o", output], stdin=subprocess.PIPE, stderr=errors, encoding='utf-8')
+    broken = False
+
+    try:
+        yield process.stdin
+    except BrokenPipeError:
+        broken = True
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            broken = True
+
+        status = process.wait()
+        errors.seek(0)
+        messages = errors.read().decode('utf-8', 'replace')
+        errors.close()
+
+    if status != 0 or broken:
+        raise DotError(status, process.args, None, messages)
+
+    if messages:
+        print(messages, end="", file=sys.stderr)
+
+# A failed dot run; the message includes what dot printed
+class DotError(subprocess.CalledProcessError):
+    def __str__(self):
+        if not self.stderr or not self.stderr.strip():
+            return super().__str__()
+
+        return f"dot exited with status {self.returncode}: {self.stderr.strip()}"
+
+def start_dot(arguments, **kwargs):
+    try:
+        return subprocess.Popen(["dot"] + arguments, **kwargs)
+    except FileNotFoundError:
+        raise RuntimeError("failed to execute dot, make sure the Graphviz executables are on your system's PATH") from None
+
+# Run function(*args) and return how long it took
+def timed_call(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def run_dot(source, output, format):
+    with dot_output(output, format) as out:
+        out.write(source)
+
+# Render several graphs with a single dot process: all sources go into one input
+# file, dot -O writes one output per graph (graphs.gv.<fmt>, graphs.gv.2.<fmt>,
+# graphs.gv.3.<fmt>, ...) and those are moved to their final names.
+def run_dot_batch(jobs, format):
+    if format == "dot" or len(jobs) == 1:
+        for source, output in jobs:
+            run_dot(source, output, format)
+
+        return
+
+    directory = os.path.dirname(jobs[0][1]) or "."
+
+    with tempfile.TemporaryDirectory(prefix=".wiring-", dir=directory) as tmp:
+        with open(os.path.join(tmp, "graphs.gv"), 'w', encoding='utf-8') as f:
+            for source, output in jobs:
+                f.write(source)
+
+        process = start_dot(["-T" + format, "-O", "graphs.gv"], cwd=tmp, stderr=subprocess.PIPE, encoding='utf-8', errors='replace')
+        messages = process.communicate()[1]
+
+        if process.returncode != 0:
+            raise DotError(process.returncode, process.args, None, messages)
+
+        if messages:
+            print(messages, end="", file=sys.stderr)
+
+        for i, (source, output) in enumerate(jobs):
+            rendered = os.path.join(tmp, "graphs.gv" + (f".{i + 1}" if i else "") + "." + format)
+
+            if not os.path.exists(rendered):
+                raise RuntimeError(f"dot did not write {os.path.basename(rendered)} for {output}")
+
+            shutil.move(rendered, output)
+
+# The table only depends on the device and its connection counts, so it is
+# built once and kept on the device until Device.connect() changes a count.
+def create_table(device):
+    if device.table is not None:
+        return device.table
+
+    is_node = len(device.pins) == 0
+
+    table = '<<table border="1" cellspacing="0" cellpadding="2">'
+
+    if is_node:
+        table += f'<tr><td colspan="3" bgcolor="{title_color}">{device.name} ({device.connection_count_total})</td></tr>'
+    else:
+        table += f'<tr><td colspan="3" bgcolor="{title_color}">{device.name}</td></tr>'
+
+    if device.info:
+        table += f'<tr><td colspan="3">{device.info}</td></tr>'
+
+    fmt = '<tr><td port="{1}w" bgcolor="{3}">{0}</td><td bgcolor="{3}">{1}</td><td port="{1}e" bgcolor="{3}">{2}</td></tr>'
+
+    for i in range(len(device.pins)):
+        pin_name = device.pins[i]
+
+        if pin_name is None:
+            table += f'<tr><td>{i + 1}</td><td></td><td></td></tr>'
+        else:
+            number_of_connections = device.connection_count[pin_name]
+
+            bgcolor = "white"
+
+            if number_of_connections != 1:
+                bgcolor = "pink"
+
+            if pin_name in device.unused_set:
+                bgcolor = "lightgrey"
 
-            font = "Roboto"
+            if device.colors and i < len(device.colors) and device.colors[i]:
+                table += fmt.format(i + 1, pin_name, device.colors[i], bgcolor)
+            else:
+                table += fmt.format(i + 1, pin_name, '', bgcolor)
+
+    table += '</table>>'
 
-            dot.attr('graph',
-                rankdir='LR',
-                ranksep='2',
-                bgcolor="#FFFFFF" if args.white else "#CCCCCC",
-                nodesep='0.33',
-                fontname=font)
-            dot.attr('node',
-                shape='box',
-                width='0', height='0', margin='0',  # Actual size of the node is entirely determined by the label.
-                style='filled',
-                fillcolor='#F0F0F0',
-                fontname=font)
-            dot.attr('edge',
-                style='bold',
-                fontname=font)
+    device.table = table
 
-        group = "Unconnected"
+    return table
 
-        groupName = 'cluster_' + group
+# Parse the input file into a Doc, or load the Doc (including its diagnostics)
+# from the model cache if the file hasn't changed since the last run.
+def load_doc(input_file, cache_dir, args, out, profile):
+    with profile.phase("read"):
+        # the options that change the model are part of the key
+        key = hashlib.sha256(f"{__version__}\0{model_cache_format}\0stream={bool(args.stream)}\0".encode("utf-8"))
 
-        with dot.subgraph(name=groupName) as sg:
-            sg.graph_attr['label'] = group
-            for device in unused_devices:
-                node = group + "_" + device.name
-                sg.node(node, label=create_table(device), shape='plaintext')
+        with open(input_file, 'rb') as stream:
+            if args.stream:
+                for chunk in iter(lambda: stream.read(1 << 20), b""):
+                    key.update(chunk)
+            else:
+                data = stream.read()
+                key.update(data)
 
-        dot.format = args.format
+        key = key.hexdigest()
 
-        filename = output_pre if args.combine or group == "default" else output_pre + "_" + group
+    cache = ModelCache(cache_dir, input_file) if args.model_cache and not args.no_cache else None
 
-        filename.replace(" ", "_")
+    if cache is not None:
+        with profile.phase("model cache"):
+            cached = cache.load(key)
 
-        if not args.combine:
+        if cached is not None:
             if args.verbose:
-                print("Creating " + filename + "." + args.format)
+                print("Using cached model", file=out)
+
+            return cached
 
-            dot.render(filename=filename, view=False, cleanup=True)
+    dependencies = {} # map from included file to its key
 
-            if args.show:
-                os.system("eom -n \"" + filename + ".png\" &")
+    if args.stream:
+        if args.verbose:
+            print(f'Streaming YAML file...', file=out)
 
-    # unused_devices = []
+        dependencies[input_file] = None # an include of the file itself is skipped
+        include = partial(load_includes, input_file, cache_dir=cache_dir, args=args, out=out, loaded=dependencies)
 
-    # for device in doc.devices.values():
-    #     if device.connection_count_total == 0:
-    #         unused_devices.append(device)
+        with profile.phase("stream"), open(input_file, 'rb') as stream:
+            doc = stream_doc(stream, include)
+    else:
+        if args.verbose:
+            print(f'Parsing YAML file...', file=out)
 
-    # if len(unused_devices) > 0:
-    #     groupName = 'cluster_Unused'
-    #     with dot.subgraph(name=groupName) as sg:
-    #         sg.graph_attr['label'] = "Unused"
-    #         for u in unused_devices:
-    #             node = group + "_" + u.name
-    #             sg.node(node, label=create_table(u), shape='plaintext')
+        with profile.phase("yaml"):
+            yaml, lines = load_with_lines(data)
+            del data
 
-    if args.combine:
         if args.verbose:
-            print("Creating " + filename + "." + args.format)
+            print("Generating graph...", file=out)
+
+        if type(yaml) == dict and yaml.get("include"):
+            doc, dependencies = load_project(input_file, yaml, cache_dir, args, out, lines, profile)
+        else:
+            doc = Doc(yaml, lines, profile)
+
+    dependencies.pop(input_file, None)
+
+    if cache is not None:
+        with profile.phase("model cache"):
+            cache.store(key, doc, out, dependencies)
+
+    return doc
+
+# Build the Doc of a file with an include section: every included file (and the
+# files they include, each file only once) is parsed separately and cached by
+# its contents in the fragment cache, so only changed files are parsed again.
+# The devices and connections of all files are then added to one Doc, included
+# files first. Returns the Doc and a map from each included file to its key.
+def load_project(input_file, yaml, cache_dir, args, out, lines=None, profile=None):
+    if profile is None:
+        profile = Profile()
+
+    with profile.phase("model"):
+        loaded = {input_file: None}
+        fragments, missing = load_includes(input_file, yaml.get("include"), cache_dir, args, out, loaded)
+        fragments.append(Fragment(yaml, lines))
+
+    with profile.phase("validation"):
+        doc = Doc()
+
+        for path in missing:
+            doc.warn("include-not-found", "Included file not found: " + path)
+
+        for fragment in fragments:
+            if fragment.colors:
+                doc.add_colors(fragment.colors)
 
-        dot.render(filename=filename, view=False, cleanup=True)
+        for fragment in fragments:
+            for device in fragment.devices:
+                doc.add_parsed_device(device)
 
-        if args.show:
-            os.system("eom -n \"" + filename + ".svg\" &")
+        for fragment in fragments:
+            for connection in fragment.connections:
+                doc.add_parsed_connection(connection)
+
+        doc.finish()
+
+    del loaded[input_file]
+
+    return doc, loaded
+
+# Load the files in an include section (a file name or a list of them, relative
+# to input_file) and the files they include. Files already in loaded are
+# skipped. Returns the fragments, each file's includes before the file itself,
+# and the files that don't exist.
+def load_includes(input_file, includes, cache_dir, args, out, loaded):
+    if type(includes) == str:
+        includes = [includes]
+
+    assert type(includes) == list, "include must be a file name or a list of file names (in file: " + input_file + ")"
+
+    fragments = []
+    missing = []
+
+    for name in includes:
+        path = os.path.abspath(os.path.join(os.path.dirname(input_file), str(name)))
+
+        if path in loaded:
+            continue
+
+        try:
+            key = file_key(path)
+        except OSError:
+            missing.append(path)
+            continue
+
+        loaded[path] = key
+        cache = FragmentCache(cache_dir, key) if args.model_cache and not args.no_cache else None
+        fragment = cache.load(key) if cache is not None else None
+
+        if fragment is None:
+            if args.verbose:
+                print(f"Parsing included file {path}...", file=out)
+
+            with open(path, 'rb') as f:
+                fragment = Fragment(*load_with_lines(f)) # errors name the included file
+
+            if cache is not None:
+                cache.store(key, fragment, out)
+
+        included, included_missing = load_includes(path, fragment.includes, cache_dir, args, out, loaded)
+        fragments.extend(included)
+        fragments.append(fragment)
+        missing.extend(included_missing)
+
+    return fragments, missing
+
+# Cache key for a file: the hash of the tool version, the cache format and the
+# file contents
+def file_key(path):
+    key = hashlib.sha256(f"{__version__}\0{model_cache_format}\0".encode("utf-8"))
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            key.update(chunk)
+
+    return key.hexdigest()
+
+# The parsed contents of one file of a project: its colors and includes as they
+# are, and its devices and connections already turned into Device and Connection
+# objects (with their own checks done). Doesn't need the other files, so it can
+# be cached on its own.
+class Fragment:
+    def __init__(self, yaml, lines=None):
+        if yaml is None:
+            yaml = {}
+
+        assert type(yaml) == dict, "the top level of an included file must be a mapping"
+
+        connections = yaml.get("connections") or []
+        lines = lines or [0] * len(connections)
+
+        self.colors = yaml.get("colors") or []
+        self.includes = yaml.get("include") or []
+        self.devices = [Device(device) for device in yaml.get("devices") or []]
+        self.connections = [Connection(connection, line) for connection, line in zip(connections, lines)]
+
+# Version of the cache files: the layout of what is pickled (the payload tuple
+# and the Doc/Fragment/Device/Connection classes). It is stored first in every
+# payload and is part of every key, so it must be increased whenever any of
+# those change.
+model_cache_format = 4
+
+# Pickled Doc for one input file, keyed by the hash of the file contents, the
+# tool version, model_cache_format and the load options. The keys of the files
+# it includes are stored with it, and it is only used while they still match.
+# Loading a pickle can run arbitrary code, so this cache (and the fragment
+# cache) is only used with --model-cache, for cache directories you trust.
+class ModelCache:
+    def __init__(self, directory, input_file):
+        self.directory = directory
+        name = hashlib.sha256(input_file.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(directory, "model-" + name + ".pickle")
+
+    # Anything unexpected in the file (another layout, a different key, a changed
+    # included file) is a miss
+    def load(self, key):
+        try:
+            with open(self.path, 'rb') as f:
+                cache_format, cached_key, doc, dependencies = pickle.load(f)
+
+            if cache_format != model_cache_format or cached_key != key:
+                return None
+
+            for path, dependency_key in dependencies.items():
+                if file_key(path) != dependency_key:
+                    return None
+        except Exception:
+            return None
+
+        return doc
+
+    def store(self, key, doc, out, dependencies=None):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+
+            tmp = self.path + ".tmp"
+
+            with open(tmp, 'wb') as f:
+                pickle.dump((model_cache_format, key, doc, dependencies or {}), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmp, self.path)
+        except (OSError, pickle.PicklingError) as e:
+            print(f"Warning: could not write model cache {self.path}: {e}", file=out)
+
+# Pickled Fragment of an included file, named after its key so that every
+# harness sharing the cache directory shares it
+class FragmentCache(ModelCache):
+    def __init__(self, directory, key):
+        self.directory = directory
+        self.path = os.path.join(directory, "fragment-" + key + ".pickle")
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Generate cable and wiring harness documentation from YAML descriptions')
     parser.add_argument('--version', action='version', version='%(prog)s ' + __version__)
-    parser.add_argument('input_file', action='store', type=str, metavar='YAML_FILE')
+    parser.add_argument('input_files', action='store', type=str, nargs='+', metavar='YAML_FILE', help='Input file(s); glob patterns are expanded')
     parser.add_argument('-s', '--show', action='store_true', help='Show the generated SVG file')
     parser.add_argument('-c', '--combine', action='store_true', help='Combine all groups into one SVG file')
     parser.add_argument('-v', '--verbose', action='store_true', help='Print verbose output')
     parser.add_argument('-w', '--white', action='store_true', help='Use white background instead of gray')
     parser.add_argument('-f', '--format', action='store', default='png', help='One of png, svg, pdf, or dot')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1, metavar='N', help='Render up to N graphs (or process up to N input files) in parallel (0 for one per CPU)')
+    parser.add_argument('--batch-render', action='store', type=int, default=None, metavar='N', help='Render up to N graphs with each dot process instead of one per graph (0 for all of them in one)')
+    parser.add_argument('--cache-dir', action='store', default=None, metavar='DIR', help='Directory for the model and render caches (default: .wiring-cache next to the input file)')
+    parser.add_argument('--model-cache', action='store_true', help='Cache the parsed model in the cache directory and reuse it while the input is unchanged (the cache is pickled Python objects: only use with a cache directory you trust)')
+    parser.add_argument('--max-nodes', action='store', type=int, default=None, metavar='N', help='Split groups with more than N devices into smaller graphs')
+    parser.add_argument('--max-edges', action='store', type=int, default=None, metavar='N', help='Split groups with more than N wires into smaller graphs')
+    parser.add_argument('--check-only', action='store_true', help='Only check the input file and report problems, without running Graphviz (exit status 1 if there are any)')
+    parser.add_argument('--max-warnings', action='store', type=int, default=None, metavar='N', help='Print at most N warnings')
+    parser.add_argument('--diagnostics-json', action='store', default=None, metavar='FILE', help='Write all warnings as JSON to FILE (- for stdout)')
+    parser.add_argument('--bom', action='store', default=None, metavar='FILE', help='Write the wire counts by color and device pair to FILE (JSON for .json, also with the counts per color, group and pin; otherwise CSV; - for CSV on stdout)')
+    parser.add_argument('--profile', action='store_true', help='Print the time taken by each phase, counters and per-graph render times')
+    parser.add_argument('--profile-json', action='store', default=None, metavar='FILE', help='Write the --profile results as JSON to FILE (- for stdout)')
+    parser.add_argument('--cprofile', action='store', default=None, metavar='FILE', help='Write a cProfile of the whole run to FILE (for pstats/snakeviz)')
+    parser.add_argument('--overview', action='store_true', help='Also render NAME.overview, a graph with one node per group linking to that group\'s file (use with -f svg)')
+    parser.add_argument('--diff', action='store_true', help='Compare two input files (OLD NEW) and render only the wires and devices that changed to NEW_diff')
+    parser.add_argument('--watch', action='store_true', help='Keep running and check and render the input file again whenever it changes, re-rendering only the changed groups')
+    parser.add_argument('--watch-interval', action='store', type=float, default=0.5, metavar='SECONDS', help='How often --watch checks the input file (default 0.5)')
+    parser.add_argument('--stream', action='store_true', help='Build the model while parsing, one device/connection at a time (lower peak memory for very large files)')
+    parser.add_argument('--no-cache', action='store_true', help='Always parse the input and render every graph, ignoring the model (with --model-cache) and render caches')
     # parser.add_argument('-n', '--no-output', action='store_true', default=False)
 
     args = parser.parse_args()
 
-    args.input_file = os.path.abspath(args.input_file)
+    input_files = []
+
+    for pattern in args.input_files:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+
+        if not matches:
+            matches = [pattern] # reported as missing later
+
+        for input_file in matches:
+            input_file = os.path.abspath(input_file)
+
+            if input_file not in input_files:
+                input_files.append(input_file)
+
+    args.input_files = input_files
+
+    if args.jobs < 0:
+        parser.error("--jobs must be 0 or greater")
+
+    if args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
+
+    if args.batch_render is not None and args.batch_render < 0:
+        parser.error("--batch-render must be 0 or greater")
+
+    for option, value in (("--max-nodes", args.max_nodes), ("--max-edges", args.max_edges)):
+        if value is not None and value < 1:
+            parser.error(option + " must be 1 or greater")
+
+    if args.watch and len(args.input_files) != 1:
+        parser.error("--watch takes a single input file")
+
+    if args.overview and args.combine:
+        parser.error("--overview can't be used with --combine")
+
+    if args.diff and len(args.input_files) != 2:
+        parser.error("--diff takes two different input files, OLD and NEW")
+
+    if args.cache_dir is not None:
+        args.cache_dir = os.path.abspath(args.cache_dir)
 
     return args
 
+# wiring.py query FILE [ENDPOINT ...]: print the net each endpoint ("Device:Pin",
+# or just "Device" for a pin-less junction) is on, and optionally report shorted
+# rails and export the net list.
+def query_main(argv):
+    parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]) + " query", description='Query the electrical nets of a wiring description')
+    parser.add_argument('input_file', action='store', type=str, metavar='YAML_FILE', help='Input file')
+    parser.add_argument('endpoints', action='store', type=str, nargs='*', metavar='ENDPOINT', help='Print everything connected to ENDPOINT (Device:Pin or Device)')
+    parser.add_argument('--shorts', action='store_true', help='Report nets that join more than one rail (exit status 1 if there are any)')
+    parser.add_argument('--rail', action='append', default=None, metavar='ENDPOINT', help='Treat ENDPOINT as a rail for --shorts (can be repeated; default: every pin-less junction device)')
+    parser.add_argument('--netlist', action='store', default=None, metavar='FILE', help='Write the connected nets as JSON to FILE (- for stdout)')
+    parser.add_argument('--cache-dir', action='store', default=None, metavar='DIR', help='Directory for the model cache (default: .wiring-cache next to the input file)')
+    parser.add_argument('--model-cache', action='store_true', help='Cache the parsed model in the cache directory (pickled Python objects: only use with a cache directory you trust)')
+    parser.add_argument('--stream', action='store_true', help='Build the model while parsing (lower peak memory for very large files)')
+    parser.add_argument('--no-cache', action='store_true', help='Always parse the input, ignoring the model cache')
+
+    args = parser.parse_args(argv)
+    args.verbose = False
+
+    input_file = os.path.abspath(args.input_file)
+
+    if not os.path.isfile(input_file):
+        print("Error: Input file not found: " + input_file)
+        return 1
+
+    cache_dir = os.path.abspath(args.cache_dir) if args.cache_dir else os.path.join(os.path.dirname(input_file), ".wiring-cache")
+
+    doc = load_doc(input_file, cache_dir, args, sys.stdout, Profile())
+    index = NetIndex(doc)
+    status = 0
+
+    for text in args.endpoints:
+        endpoint = index.endpoint(text)
+
+        if endpoint is None:
+            print("Error: Unknown endpoint: " + text)
+            status = 1
+            continue
+
+        print(format_endpoint(endpoint))
+
+        for member in index.members(endpoint):
+            if member != endpoint:
+                print("  " + format_endpoint(member))
+
+    if args.shorts:
+        rails = None
+
+        if args.rail is not None:
+            rails = []
+
+            for text in args.rail:
+                endpoint = index.endpoint(text)
+
+                if endpoint is None:
+                    print("Error: Unknown endpoint: " + text)
+                    return 1
+
+                rails.append(endpoint)
+
+        for rails_on_net in index.shorts(rails):
+            print("Warning: Short between " + ", ".join(format_endpoint(rail) for rail in rails_on_net))
+            status = 1
+
+    if args.netlist:
+        write_json(args.netlist, index.netlist(), sys.stdout)
+
+    return status
+
+# Runs dot for each graph. Without the cache, a pool or batching the DOT source
+# is streamed straight into dot (or the output file for -f dot). With more than
+# one job the renders are handed to a thread pool (each one is just a wait on a
+# Graphviz subprocess), but progress messages are still printed in submission
+# order so the output matches a serial run. With --batch-render the graphs are
+# collected and rendered by one dot process per batch.
+class Renderer:
+    def __init__(self, args, cache_dir, out, profile):
+        self.args = args
+        self.out = out
+        self.profile = profile
+        self.pool = ThreadPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+        self.pending = [] # (future, [(output file, key, file to show), ...]) in submission order
+        self.queued = [] # (source, output file, key, file to show) waiting for a batch render
+        self.cache = None if args.no_cache else get_render_cache(cache_dir)
+        self.hits = 0
+        self.misses = 0
+
+    # write(out) writes the graph's DOT source to a text stream
+    def render(self, write, filename, show_file):
+        output = filename + "." + self.args.format
+
+        if self.cache is None and self.pool is None and self.args.batch_render is None:
+            if self.args.verbose:
+                print("Creating " + output, file=self.out)
+
+            start = time.perf_counter()
+
+            with dot_output(output, self.args.format) as out:
+                writer = write(out)
+
+            self.profile.graph(output, writer)
+            self.profile.rendered(output, time.perf_counter() - start)
+            self.show(show_file)
+            return
+
+        source = io.StringIO()
+        writer = write(source)
+        source = source.getvalue()
+        key = dot_hash(source)
+
+        self.profile.graph(output, writer)
+
+        if self.cache is not None:
+            if self.cache.hit(output, key, self.args.format):
+                self.hits += 1
+                self.profile.rendered(output, None, cached=True)
+
+                if self.args.verbose:
+                    print("Up to date " + output, file=self.out)
+
+                self.show(show_file)
+                return
+
+            self.misses += 1
+
+        if self.args.verbose:
+            print("Creating " + output, file=self.out)
+
+        if self.args.batch_render is not None:
+            self.queued.append((source, output, key, show_file))
+
+            if len(self.queued) == self.args.batch_render:
+                self.flush()
+        elif self.pool is None:
+            seconds = timed_call(run_dot, source, output, self.args.format)
+            self.rendered(output, key, show_file, seconds)
+        else:
+            future = self.pool.submit(timed_call, run_dot, source, output, self.args.format)
+            self.pending.append((future, [(output, key, show_file)]))
+
+    # Render the queued graphs with one dot process
+    def flush(self):
+        if not self.queued:
+            return
+
+        jobs = [(source, output) for source, output, key, show_file in self.queued]
+        done = [(output, key, show_file) for source, output, key, show_file in self.queued]
+        self.queued = []
+
+        if self.pool is None:
+            seconds = timed_call(run_dot_batch, jobs, self.args.format)
+
+            for output, key, show_file in done:
+                self.rendered(output, key, show_file, seconds, len(done))
+        else:
+            future = self.pool.submit(timed_call, run_dot_batch, jobs, self.args.format)
+            self.pending.append((future, done))
+
+    def rendered(self, output, key, show_file, seconds, batch=1):
+        if self.cache is not None:
+            self.cache.store(output, key, self.args.format)
+
+        self.profile.rendered(output, seconds, batch=batch)
+        self.show(show_file)
+
+    def finish(self):
+        try:
+            self.flush()
+
+            for future, done in self.pending:
+                seconds = future.result()
+
+                for output, key, show_file in done:
+                    self.rendered(output, key, show_file, seconds, len(done))
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+
+            self.pending = []
+            self.queued = []
+
+            if self.cache is not None:
+                self.cache.save(self.out)
+
+                if self.args.verbose:
+                    print(f"Render cache: {self.hits} hits, {self.misses} misses", file=self.out)
+
+    def show(self, show_file):
+        if self.args.show and show_file:
+            os.system("eom -n \"" + show_file + "\" &")
+
+# Hash of the DOT source in a canonical form (unix line endings, no trailing
+# whitespace), so that cosmetic differences don't force a re-render.
+def dot_hash(source):
+    lines = [line.rstrip() for line in source.replace("\r\n", "\n").split("\n")]
+    canonical = "\n".join(lines).strip("\n")
+
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+render_caches = {} # map from cache directory to its RenderCache, shared by all input files of a run
+render_caches_lock = threading.Lock()
+
+def get_render_cache(directory):
+    with render_caches_lock:
+        if directory not in render_caches:
+            render_caches[directory] = RenderCache(directory)
+
+        return render_caches[directory]
+
+# Remembers the source hash and format of every output file that was rendered,
+# and the file's modification time and size afterwards, so unchanged graphs can
+# be skipped as long as the output file is still the one that was rendered
+# (not written by a --no-cache run or anything else since).
+class RenderCache:
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, "render.json")
+        self.entries = {} # map from output file to {"hash": ..., "format": ..., "stamp": [mtime, size]}
+        self.dirty = False
+        self.lock = threading.Lock()
+
+        try:
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+        if type(self.entries) != dict:
+            self.entries = {}
+
+    def hit(self, output, key, format):
+        entry = self.entries.get(output)
+        stamp = file_stamp(output)
+
+        return stamp is not None and entry == {"hash": key, "format": format, "stamp": list(stamp)}
+
+    def store(self, output, key, format):
+        stamp = file_stamp(output)
+
+        with self.lock:
+            if stamp is not None:
+                self.entries[output] = {"hash": key, "format": format, "stamp": list(stamp)}
+            else:
+                self.entries.pop(output, None)
+
+            self.dirty = True
+
+    def save(self, out):
+        with self.lock:
+            if not self.dirty:
+                return
+
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+
+                tmp = self.path + ".tmp"
+
+                with open(tmp, 'w') as f:
+                    json.dump(self.entries, f, indent=1, sort_keys=True)
+
+                os.replace(tmp, self.path)
+            except OSError as e:
+                print(f"Warning: could not write render cache {self.path}: {e}", file=out)
+
+            self.dirty = False
+
+# A Doc can be built in one go from a parsed YAML document, or filled in one
+# device/connection at a time (see stream_doc) and then completed with finish().
+# All checks happen while it is built: each connection is checked as it is added
+# and each device once in finish(), so validation is a single pass over the
+# connections and pins. Findings are collected in diagnostics rather than printed.
+# Built from YAML, the devices and connections are first turned into Device and
+# Connection objects ("model" in the profile) and then added ("validation").
 class Doc:
-    def __init__(self, yaml):
+    def __init__(self, yaml=None, lines=None, profile=None):
         self.devices = {}
         self.groups = {}
+        self.color_registry = ColorRegistry()
+        self.diagnostics = []
+        self.deprecated_colors = set() # long color names that have been reported
 
-        if yaml["devices"] is None:
-            yaml["devices"] = []
+        if yaml is None:
+            return
 
-        for device in yaml["devices"]:
-            name = device["name"]
-            if name in self.devices:
-                print("Warning: Duplicate device name: " + name)
-                continue
-            self.devices[name] = Device(device)
+        if profile is None:
+            profile = Profile()
 
-        if yaml["connections"] is None:
-            yaml["connections"] = []
+        with profile.phase("model"):
+            devices = [Device(device) for device in yaml["devices"] or []]
+            connections = yaml["connections"] or []
+            lines = lines or [0] * len(connections)
+            connections = [Connection(connection, line) for connection, line in zip(connections, lines)]
 
-        for connection in yaml["connections"]:
-            c = Connection(connection)
+        with profile.phase("validation"):
+            if yaml.get("colors"):
+                self.add_colors(yaml["colors"])
 
-            if c.fromDevice not in self.devices:
-                print("Warning: " + c.fromDevice + " not defined")
-                self.devices[c.fromDevice] = Device({"name": c.fromDevice})
+            for device in devices:
+                self.add_parsed_device(device)
 
-            if c.toDevice not in self.devices:
-                print("Warning: " + c.toDevice + " not defined")
-                self.devices[c.toDevice] = Device({"name": c.toDevice})
+            for connection in connections:
+                self.add_parsed_connection(connection)
 
-            for i in range(len(c.fromPins)):
-                if c.fromPins[i] not in self.devices[c.fromDevice].pins:
-                    print("Warning: Pin " + c.fromPins[i] + " not found in device " + c.fromDevice)
-                    continue
+            self.finish()
 
-                self.devices[c.fromDevice].connection_count[c.fromPins[i]] += 1
-                self.devices[c.fromDevice].connection_count_total += 1
+    def warn(self, code, message, device=None, pin=None, line=0):
+        self.diagnostics.append(Diagnostic(code, message, device, pin, line))
 
-            if len(c.fromPins) == 0:
-                if len(self.devices[c.fromDevice].pins) != 0:
-                    print("Warning: Device " + c.fromDevice + " has pins, but connection " + c.fromDevice + " -> " + c.toDevice + " does not specify any pins")
-                else:
-                    self.devices[c.fromDevice].connection_count_total += 1
+    # The problems found while building the document (all checks run as it is built)
+    def validate(self):
+        return list(self.diagnostics)
+
+    def add_colors(self, yaml):
+        for entry in self.color_registry.load(yaml):
+            self.warn("color-definition", f"Invalid color definition: {entry}")
+
+    def add_device(self, yaml):
+        name = yaml["name"]
+        if name in self.devices:
+            self.warn("duplicate-device", "Duplicate device name: " + name, name)
+            return
+        self.devices[name] = Device(yaml)
+
+    def add_parsed_device(self, device):
+        if device.name in self.devices:
+            self.warn("duplicate-device", "Duplicate device name: " + device.name, device.name)
+            return
+        self.devices[device.name] = device
+
+    def add_connection(self, yaml, lineNumber=0):
+        self.add_parsed_connection(Connection(yaml, lineNumber))
 
-            for i in range(len(c.toPins)):
-                if c.toPins[i] not in self.devices[c.toDevice].pins:
-                    print("Warning: Pin " + c.toPins[i] + " not found in device " + c.toDevice)
+    def add_parsed_connection(self, c):
+        line = c.lineNumber
+        description = f"{c.fromDevice}:{c.fromPins} -> {c.toDevice}:{c.toPins}"
+
+        for color in c.colors:
+            self.check_color(color, f"at: line {line}" if line else "at: ?", None, line)
+
+        if c.fromDevice not in self.devices:
+            self.warn("undefined-device", c.fromDevice + " not defined", c.fromDevice, None, line)
+            self.devices[c.fromDevice] = Device({"name": c.fromDevice})
+
+        if c.toDevice not in self.devices:
+            self.warn("undefined-device", c.toDevice + " not defined", c.toDevice, None, line)
+            self.devices[c.toDevice] = Device({"name": c.toDevice})
+
+        fromDevice = self.devices[c.fromDevice]
+        toDevice = self.devices[c.toDevice]
+
+        # wire colors can only be compared with the device colors if every wire has a
+        # color and every pin exists; an end without pins (a pin-less device) is skipped
+        check_colors = True
+
+        for device, pins in ((fromDevice, c.fromPins), (toDevice, c.toPins)):
+            for pin in pins:
+                if pin not in device.pin_index:
+                    self.warn("pin-not-found", "Pin " + str(pin) + " not found in device " + device.name, device.name, pin, line)
+                    check_colors = False
                     continue
 
-                self.devices[c.toDevice].connection_count[c.toPins[i]] += 1
-                self.devices[c.toDevice].connection_count_total += 1
+                device.connect(pin)
 
-            if len(c.toPins) == 0:
-                if len(self.devices[c.toDevice].pins) != 0:
-                    print("Warning: Device " + c.toDevice + " has pins, but connection " + c.fromDevice + " -> " + c.toDevice + " does not specify any pins")
+            if len(pins) == 0:
+                if len(device.pins) != 0:
+                    self.warn("pins-missing", "Device " + device.name + " has pins, but connection " + c.fromDevice + " -> " + c.toDevice + " does not specify any pins", device.name, None, line)
+                    check_colors = False
                 else:
-                    self.devices[c.toDevice].connection_count_total += 1
+                    device.connect()
+
+        if len(c.fromPins) != len(c.toPins) and len(c.fromPins) != 0 and len(c.toPins) != 0:
+            self.warn("pin-count", f"connection {description} has different number of from/to pins", None, None, line)
+            check_colors = False
+        elif len(c.colors) != max(len(c.fromPins), len(c.toPins), 1):
+            self.warn("color-count", f"connection {description} has different number of colors and pins", None, None, line)
+            check_colors = False
+
+        if check_colors:
+            for device, pins in ((fromDevice, c.fromPins), (toDevice, c.toPins)):
+                if not device.colors or len(device.pins) != len(device.colors):
+                    continue
 
-            if "group" not in connection:
-                connection["group"] = "default"
+                for pin, color in zip(pins, c.colors):
+                    device_color = device.colors[device.pin_index[pin]]
 
-            if connection["group"] not in self.groups:
-                self.groups[connection["group"]] = []
+                    if self.color_registry.get(device_color) != self.color_registry.get(color):
+                        self.warn("color-mismatch", f"in connection {description} color {color} doesn't match device {device.name} color {device_color}", device.name, pin, line)
 
-            self.groups[connection["group"]].append(c)
+        if c.group not in self.groups:
+            self.groups[c.group] = []
 
+        self.groups[c.group].append(c)
+
+    def check_color(self, color, where, device=None, line=0):
+        if not self.color_registry.valid(color):
+            self.warn("color-invalid", f"Invalid color: {color} {where}", device, None, line)
+        elif self.color_registry.deprecated(color) and color not in self.deprecated_colors:
+            self.deprecated_colors.add(color)
+            self.warn("color-deprecated", f"color code {color} is deprecated, please use {self.color_registry.codes[color]} instead", device, None, line)
+
+    # Checks that need every connection to have been added
+    def finish(self):
         for device in self.devices.values():
-            if device.connection_count_total == 0:
-                print("Warning: Device " + device.name + " is not connected to anything")
+            self.check_device(device)
+
+    def check_device(self, device):
+        for unused in device.unused:
+            if unused not in device.pin_index:
+                self.warn("unused-not-found", "Unused pin " + str(unused) + " not found in device " + device.name, device.name, unused)
+
+        if device.colors:
+            if len(device.pins) != len(device.colors):
+                self.warn("device-color-count", "device " + device.name + " has different number of pins and colors", device.name)
+
+            for color in device.colors:
+                if color:
+                    self.check_color(color, "in device " + device.name, device.name)
+
+        if device.connection_count_total == 0:
+            self.warn("unconnected-device", "Device " + device.name + " is not connected to anything", device.name)
+            return
+
+        for pin_name, count in device.connection_count.items():
+            if pin_name is None:
+                continue
+
+            if count > 1:
+                self.warn("pin-multiple", "Pin " + device.name + ":" + pin_name + " is connected to " + str(count) + " other devices", device.name, pin_name)
+            elif count == 0:
+                if pin_name not in device.unused_set:
+                    self.warn("pin-unconnected", "Pin " + device.name + ":" + pin_name + " is not connected to anything", device.name, pin_name)
+            else:
+                if pin_name in device.unused_set:
+                    self.warn("unused-connected", "Pin " + device.name + ":" + pin_name + " is connected to something, but marked as unused", device.name, pin_name)
+
+# Keeps the Doc of a file between edits for --watch. update() compares the new
+# YAML with the previous one by device and by group: groups whose connections
+# and devices are unchanged keep their Connection objects and diagnostics, and
+# only the devices touched by a change get their pin counts and checks redone.
+class IncrementalDoc:
+    def __init__(self, yaml):
+        self.build(yaml)
+
+    def build(self, yaml):
+        doc = Doc()
+        colors, devices, groups = self.split(yaml)
+
+        if yaml.get("colors"):
+            doc.add_colors(yaml["colors"])
+
+        self.color_diagnostics = doc.diagnostics[:]
+
+        for device in yaml["devices"] or []:
+            doc.add_device(device)
+
+        header_diagnostics = doc.diagnostics[len(self.color_diagnostics):]
+        self.group_diagnostics = {}
+
+        for group, connections in groups.items():
+            self.group_diagnostics[group] = self.add_group(doc, [Connection(connection) for key, connection in connections])
+
+        self.device_diagnostics = {}
+
+        for device in doc.devices.values():
+            self.device_diagnostics[device.name] = self.check_device(doc, device)
+
+        self.assemble(doc, header_diagnostics, devices)
+        self.doc = doc
+        self.colors = colors
+        self.devices = devices
+        self.groups = {group: [key for key, connection in connections] for group, connections in groups.items()}
+
+    # The colors, devices and connections (by group) of yaml, each with a key for
+    # comparing it with the previous version
+    @staticmethod
+    def split(yaml):
+        def key(item):
+            return json.dumps(item, sort_keys=True, default=str)
+
+        devices = {}
+
+        for device in yaml["devices"] or []:
+            devices.setdefault(device["name"], key(device))
+
+        groups = {}
+
+        for connection in yaml["connections"] or []:
+            group = connection.get("group", "default") if type(connection) == dict else "default"
+            groups.setdefault(group, []).append((key(connection), connection))
+
+        return key(yaml.get("colors")), devices, groups
+
+    # Bring the Doc up to date with yaml. Returns the names of the graphs that
+    # changed (groups and "Unconnected"), or None if everything was rebuilt.
+    def update(self, yaml):
+        colors, devices, groups = self.split(yaml)
+
+        if colors != self.colors:
+            self.build(yaml)
+            return None
+
+        old = self.doc
+        changed_devices = {name for name in devices.keys() | self.devices.keys() if devices.get(name) != self.devices.get(name)}
+        changed_groups = set()
+
+        for group in groups.keys() | self.groups.keys():
+            if [key for key, connection in groups.get(group, [])] != self.groups.get(group):
+                changed_groups.add(group)
+            elif any(c.fromDevice in changed_devices or c.toDevice in changed_devices for c in old.groups[group]):
+                changed_groups.add(group)
+
+        new_connections = {group: [Connection(connection) for key, connection in groups[group]] for group in changed_groups if group in groups}
+
+        # Devices whose counts and checks have to be redone
+        affected = set(changed_devices)
+
+        for group in changed_groups:
+            for c in chain(old.groups.get(group, []), new_connections.get(group, [])):
+                affected.add(c.fromDevice)
+                affected.add(c.toDevice)
+
+        doc = Doc()
+        doc.color_registry = old.color_registry
+
+        for device in yaml["devices"] or []:
+            name = device["name"]
+
+            if name in affected or name in doc.devices or name not in old.devices:
+                doc.add_device(device)
+            else:
+                doc.devices[name] = old.devices[name]
+
+        header_diagnostics = doc.diagnostics[:]
+
+        # Count the unchanged connections of the affected devices
+        for group, connections in old.groups.items():
+            if group in changed_groups:
                 continue
 
-            for pin_name in device.connection_count:
-                if pin_name is None:
+            for c in connections:
+                for name, pins in ((c.fromDevice, c.fromPins), (c.toDevice, c.toPins)):
+                    if name not in doc.devices: # undefined device, already reported with its group
+                        doc.devices[name] = Device({"name": name}) if name in affected else old.devices[name]
+
+                    if name in affected:
+                        count_pins(doc.devices[name], pins)
+
+        group_diagnostics = {}
+
+        for group in groups:
+            if group not in changed_groups:
+                doc.groups[group] = old.groups[group]
+                group_diagnostics[group] = self.group_diagnostics[group]
+                continue
+
+            group_diagnostics[group] = self.add_group(doc, new_connections[group])
+
+        device_diagnostics = {}
+
+        for device in doc.devices.values():
+            if device.name in affected or device.name not in self.device_diagnostics:
+                device_diagnostics[device.name] = self.check_device(doc, device)
+            else:
+                device_diagnostics[device.name] = self.device_diagnostics[device.name]
+
+        self.group_diagnostics = group_diagnostics
+        self.device_diagnostics = device_diagnostics
+        self.assemble(doc, header_diagnostics, devices)
+
+        unused_before = [device.name for device in old.devices.values() if device.connection_count_total == 0]
+        unused_after = [device.name for device in doc.devices.values() if device.connection_count_total == 0]
+
+        # A device's table shows its pin counts, so every graph that draws a device
+        # whose definition or counts changed is drawn again
+        redrawn = set(changed_devices)
+
+        for name in affected:
+            device = doc.devices.get(name)
+            before = old.devices.get(name)
+
+            if device is not None and (before is None or (device.connection_count, device.connection_count_total) != (before.connection_count, before.connection_count_total)):
+                redrawn.add(name)
+
+        for group, connections in doc.groups.items():
+            if group not in changed_groups and any(c.fromDevice in redrawn or c.toDevice in redrawn for c in connections):
+                changed_groups.add(group)
+
+        if unused_before != unused_after or redrawn & (set(unused_before) | set(unused_after)):
+            changed_groups.add("Unconnected")
+
+        self.doc = doc
+        self.devices = devices
+        self.groups = {group: [key for key, connection in connections] for group, connections in groups.items()}
+
+        return changed_groups
+
+    # Add the connections of a group and return its diagnostics. Each group (and
+    # device) reports deprecated colors on its own, so that its diagnostics stay
+    # complete when other groups change; assemble() removes the repeats. Undefined
+    # devices are reported by assemble() too.
+    @staticmethod
+    def add_group(doc, connections):
+        start = len(doc.diagnostics)
+        doc.deprecated_colors = set()
+
+        for c in connections:
+            doc.add_parsed_connection(c)
+
+        return [d for d in doc.diagnostics[start:] if d.code != "undefined-device"]
+
+    @staticmethod
+    def check_device(doc, device):
+        start = len(doc.diagnostics)
+        doc.deprecated_colors = set()
+        doc.check_device(device)
+
+        return doc.diagnostics[start:]
+
+    def assemble(self, doc, header_diagnostics, devices):
+        doc.diagnostics = self.color_diagnostics + header_diagnostics
+        doc.diagnostics.extend(Diagnostic("undefined-device", name + " not defined", name) for name in doc.devices if name not in devices)
+        reported = set() # deprecated color messages
+
+        for d in chain(chain.from_iterable(self.group_diagnostics.values()), chain.from_iterable(self.device_diagnostics.values())):
+            if d.code == "color-deprecated":
+                if d.message in reported:
                     continue
 
-                if device.connection_count[pin_name] > 1:
-                    # print("Warning: Pin " + pin_name + " on device " + device.name + " is connected to " + str(device.connection_count[pin_count]) + " other devices")
-                    print("Warning: Pin " + device.name + ":" + pin_name + " is connected to " + str(device.connection_count[pin_name]) + " other devices")
-                elif device.connection_count[pin_name] == 0:
-                    if pin_name not in device.unused:
-                        print("Warning: Pin " + device.name + ":" + pin_name + " is not connected to anything")
-                else:
-                    if pin_name in device.unused:
-                        print("Warning: Pin " + device.name + ":" + pin_name + " is connected to something, but marked as unused")
+                reported.add(d.message)
+
+            doc.diagnostics.append(d)
+
+# Count a connection end the same way Doc.add_connection() does
+def count_pins(device, pins):
+    if pins:
+        for pin in pins:
+            if pin in device.pin_index:
+                device.connect(pin)
+    elif not device.pins:
+        device.connect()
+
+# One finding from building/validating a Doc
+class Diagnostic:
+    __slots__ = ('code', 'severity', 'message', 'device', 'pin', 'line')
+
+    def __init__(self, code, message, device=None, pin=None, line=0, severity="warning"):
+        self.code = code
+        self.severity = severity
+        self.message = message
+        self.device = device
+        self.pin = pin
+        self.line = line # 0 if unknown
+
+    def __str__(self):
+        return self.severity.capitalize() + ": " + self.message
+
+    def to_dict(self):
+        return {
+            "code": self.code,
+            "severity": self.severity,
+            "message": self.message,
+            "device": self.device,
+            "pin": self.pin,
+            "line": self.line or None,
+        }
+
+# Print the diagnostics (at most args.max_warnings of them) and write them as JSON
+# if asked to. Lines are written in batches rather than one print() per warning.
+def report_diagnostics(diagnostics, args, out, batch_size=1000):
+    shown = diagnostics
+
+    if args.max_warnings is not None and len(diagnostics) > args.max_warnings:
+        shown = diagnostics[:args.max_warnings]
+
+    for i in range(0, len(shown), batch_size):
+        out.write("".join(str(d) + "\n" for d in shown[i:i + batch_size]))
+
+    if len(shown) < len(diagnostics):
+        print(f"... {len(diagnostics) - len(shown)} more warnings not shown", file=out)
+
+    if args.diagnostics_json:
+        data = json.dumps([d.to_dict() for d in diagnostics], indent=1)
+
+        if args.diagnostics_json == "-":
+            print(data, file=out)
+        else:
+            with open(args.diagnostics_json, 'w') as f:
+                f.write(data + "\n")
+
+# Load a YAML document like yaml.load, also returning the line number each entry
+# of the top level connections list starts on (an empty list if there is none).
+def load_with_lines(stream):
+    loader = SafeLoader(stream)
+    lines = []
+
+    try:
+        node = loader.get_single_node()
+
+        if node is None:
+            return None, lines
+
+        if isinstance(node, MappingNode):
+            for key, value in node.value:
+                if isinstance(key, ScalarNode) and key.value == "connections" and isinstance(value, SequenceNode):
+                    lines = [item.start_mark.line + 1 for item in value.value]
+
+        return loader.construct_document(node), lines
+    finally:
+        loader.dispose()
+
+# Build a Doc straight from the YAML event stream. Each entry of the devices and
+# connections lists is composed and constructed on its own and handed to the Doc,
+# so the parse tree of the whole file is never held in memory. Connections get
+# the line number they start on. Connections that come before the devices
+# section are held back until the devices have been read.
+def stream_doc(stream, include=None):
+    doc = Doc()
+    loader = SafeLoader(stream)
+    anchors = {}
+    held = [] # (connection, line) waiting for the devices section
+    have_devices = False
+    have_connections = False
+
+    def construct(node):
+        return loader.construct_document(node)
+
+    def add_connection(item, line):
+        if type(item) == Connection: # from an included file
+            doc.add_parsed_connection(item)
+        else:
+            doc.add_connection(item, line)
+
+    try:
+        loader.get_event() # StreamStartEvent
+
+        if loader.check_event(StreamEndEvent):
+            raise YAMLError("empty input file")
+
+        loader.get_event() # DocumentStartEvent
+
+        if not loader.check_event(MappingStartEvent):
+            raise YAMLError("the top level of the input file must be a mapping")
+
+        loader.get_event()
+
+        while not loader.check_event(MappingEndEvent):
+            key = construct(compose_node(loader, anchors))
+
+            if key in ("devices", "connections") and loader.check_event(SequenceStartEvent):
+                loader.get_event()
+
+                while not loader.check_event(SequenceEndEvent):
+                    node = compose_node(loader, anchors)
+                    item = construct(node)
+
+                    if key == "devices":
+                        doc.add_device(item)
+                    elif have_devices:
+                        add_connection(item, node.start_mark.line + 1)
+                        have_connections = True
+                    else:
+                        held.append((item, node.start_mark.line + 1))
+
+                loader.get_event()
+            else:
+                value = construct(compose_node(loader, anchors))
+
+                if key == "colors" and value:
+                    if have_connections:
+                        doc.warn("colors-late", "colors section should come before the connections when streaming")
+
+                    doc.add_colors(value)
+
+                if key == "include" and value and include is not None:
+                    if have_connections:
+                        doc.warn("include-late", "include section should come before the connections when streaming")
+
+                    fragments, missing = include(value)
+
+                    for path in missing:
+                        doc.warn("include-not-found", "Included file not found: " + path)
+
+                    for fragment in fragments:
+                        if fragment.colors:
+                            doc.add_colors(fragment.colors)
+
+                    for fragment in fragments:
+                        for device in fragment.devices:
+                            doc.add_parsed_device(device)
+
+                    for fragment in fragments:
+                        for connection in fragment.connections:
+                            if have_devices:
+                                add_connection(connection, 0)
+                            else:
+                                held.append((connection, 0))
+
+            if key == "devices":
+                have_devices = True
+
+                for item, line in held:
+                    add_connection(item, line)
+
+                held = []
+
+        loader.get_event() # MappingEndEvent
+        loader.get_event() # DocumentEndEvent
+
+        if not loader.check_event(StreamEndEvent):
+            raise YAMLError("expected a single document in the input file")
+    finally:
+        loader.dispose()
+
+    for item, line in held:
+        add_connection(item, line)
+
+    doc.finish()
+
+    return doc
+
+# Compose one node from the event stream, like yaml.composer.Composer but
+# usable with both the pure Python and the libyaml based loaders.
+def compose_node(loader, anchors):
+    event = loader.get_event()
+
+    if isinstance(event, AliasEvent):
+        if event.anchor not in anchors:
+            raise YAMLError(f"found undefined alias {event.anchor} at line {event.start_mark.line + 1}")
+        return anchors[event.anchor]
+
+    if isinstance(event, ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == "!":
+            tag = loader.resolve(ScalarNode, event.value, event.implicit)
+        node = ScalarNode(tag, event.value, event.start_mark, event.end_mark, style=event.style)
+    elif isinstance(event, SequenceStartEvent):
+        tag = event.tag
+        if tag is None or tag == "!":
+            tag = loader.resolve(SequenceNode, None, event.implicit)
+        node = SequenceNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+    elif isinstance(event, MappingStartEvent):
+        tag = event.tag
+        if tag is None or tag == "!":
+            tag = loader.resolve(MappingNode, None, event.implicit)
+        node = MappingNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+    else:
+        raise YAMLError(f"unexpected {type(event).__name__} at line {event.start_mark.line + 1}")
+
+    if event.anchor is not None:
+        anchors[event.anchor] = node
+
+    if isinstance(node, SequenceNode):
+        while not loader.check_event(SequenceEndEvent):
+            node.value.append(compose_node(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+    elif isinstance(node, MappingNode):
+        while not loader.check_event(MappingEndEvent):
+            item_key = compose_node(loader, anchors)
+            item_value = compose_node(loader, anchors)
+            node.value.append((item_key, item_value))
+        node.end_mark = loader.get_event().end_mark
+
+    return node
 
 # TODO Add function to create Device from yaml, and simplify Device constructor.
 
 class Device:
+    __slots__ = ('name', 'pins', 'info', 'colors', 'unused', 'pin_index', 'unused_set', 'connection_count', 'connection_count_total', 'table')
+
     def __init__(self, yaml):
         self.name = yaml["name"]
 
@@ -464,10 +2414,11 @@ class Device:
 
         self.unused = [str(pin) if type(pin) == int else pin for pin in self.unused]
 
-        for unused in self.unused:
-            if unused not in self.pins:
-                print("Warning: Unused pin " + unused + " not found in device " + self.name)
-                continue
+        self.pin_index = {} # map from pin name to its (first) position in pins
+        for i, pin in enumerate(self.pins):
+            self.pin_index.setdefault(pin, i)
+
+        self.unused_set = set(self.unused)
 
         self.connection_count = {} # map from pin name to number of connections
         for pin in self.pins:
@@ -475,9 +2426,21 @@ class Device:
 
         self.connection_count_total = 0
 
+        self.table = None # cached create_table() result
+
+    # Count a connection to the given pin (or to the device itself if it has no pins)
+    def connect(self, pin=None):
+        if pin is not None:
+            self.connection_count[pin] += 1
+
+        self.connection_count_total += 1
+        self.table = None
+
 # TODO Possibly make each individual wire a separate connection
 class Connection:
-    def __init__(self, yaml):
+    __slots__ = ('fromDevice', 'fromPins', 'toDevice', 'toPins', 'colors', 'group', 'lineNumber')
+
+    def __init__(self, yaml, lineNumber=0):
         from_ = yaml["from"]
         to_ = yaml["to"]
 
@@ -503,35 +2466,367 @@ class Connection:
         else:
             self.colors = yaml["color"]
 
-        self.group = yaml["group"] if "group" in yaml else None
-        self.lineNumber = 0 # TODO
+        self.group = yaml["group"] if "group" in yaml else "default"
+        self.lineNumber = lineNumber # 0 if unknown
 
         assert type(self.fromDevice) == str, "Connection from device must be a string (in connection: " + self.fromDevice + " -> " + self.toDevice + ")"
         assert type(self.fromPins) == list, "Connection from pins must be a list (in connection: " + self.fromDevice + " -> " + self.toDevice + ")"
         assert type(self.toDevice) == str, "Connection to device must be a string (in connection: " + self.fromDevice + " -> " + self.toDevice + ")"
         assert type(self.toPins) == list, "Connection to pins must be a list (in connection: " + self.fromDevice + " -> " + self.toDevice + ")"
         assert type(self.colors) == list, "Connection colors must be a list (in connection: " + self.fromDevice + " -> " + self.toDevice + ")"
-        assert type(self.group) == str or self.group is None, "Connection group must be a string (in connection: " + self.fromDevice + " -> " + self.toDevice + ")"
+        assert type(self.group) == str, "Connection group must be a string (in connection: " + self.fromDevice + " -> " + self.toDevice + ")"
         assert type(self.lineNumber) == int, "Connection lineNumber must be an int (in connection: " + self.fromDevice + " -> " + self.toDevice + ")"
 
-        for c in self.colors:
-            if not valid_color(c):
-                print("Warning: Invalid color:", c, "at:", "?")
+    # Number of wires (edges in the graph)
+    def wire_count(self):
+        return max(len(self.fromPins), len(self.toPins), 1)
+
+def format_endpoint(endpoint):
+    device, pin = endpoint
+    return device if pin is None else f"{device}:{pin}"
+
+# Groups (device, pin) endpoints into electrical nets with union-find, so
+# membership and short checks don't have to walk the connections again. A
+# connection end without pins (usually a pin-less device like "Node Gnd") is
+# the endpoint (device, None), a junction that every wire of the connection
+# goes through.
+class NetIndex:
+    def __init__(self, doc):
+        self.doc = doc
+        self.ids = {} # map from endpoint to its index in endpoints/parent
+        self.endpoints = []
+        self.parent = []
+        self.size = []
+        self.nets = None # map from root to its endpoints, built on first use
+
+        for connections in doc.groups.values():
+            for connection in connections:
+                fromPins = [str(pin) for pin in connection.fromPins] or [None] * max(len(connection.toPins), 1)
+                toPins = [str(pin) for pin in connection.toPins] or [None] * len(fromPins)
 
-def get_color(code):
-    if code in [c[0] for c in color_list]:
-        return color_list[[c[0] for c in color_list].index(code)][2]
+                # zip() drops the extra wires of a pin count mismatch (already reported as pin-count)
+                for fromPin, toPin in zip(fromPins, toPins):
+                    self.union(self.id((connection.fromDevice, fromPin)), self.id((connection.toDevice, toPin)))
+
+    def id(self, endpoint):
+        i = self.ids.get(endpoint)
+
+        if i is None:
+            i = len(self.endpoints)
+            self.ids[endpoint] = i
+            self.endpoints.append(endpoint)
+            self.parent.append(i)
+            self.size.append(1)
+            self.nets = None
+
+        return i
+
+    def find(self, i):
+        parent = self.parent
+
+        while parent[i] != i:
+            parent[i] = parent[parent[i]] # path halving
+            i = parent[i]
+
+        return i
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+
+        if a == b:
+            return
+
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+    # Parse "Device:Pin" or "Device" into an endpoint, None if there is no such device or pin
+    def endpoint(self, text):
+        if text in self.doc.devices:
+            return (text, None)
+
+        name, _, pin = text.rpartition(":")
+        name = name.strip()
+        pin = pin.strip()
+
+        device = self.doc.devices.get(name)
+
+        if device is None or pin not in device.pin_index:
+            return None
+
+        return (name, pin)
 
-    if code in [c[1] for c in color_list]:
-        print("Warning: color code", code, "is deprecated, please use", color_list[[c[1] for c in color_list].index(code)][0], "instead")
-        return color_list[[c[1] for c in color_list].index(code)][2]
+    def same_net(self, a, b):
+        return self.find(self.id(a)) == self.find(self.id(b))
 
-    print(f"Warning: unknown color code {code}")
+    # Every endpoint on the same net as endpoint (including itself)
+    def members(self, endpoint):
+        i = self.id(endpoint)
+        return self.get_nets()[self.find(i)]
 
-    return color_list["BK"][2]
+    def get_nets(self):
+        if self.nets is None:
+            self.nets = {}
+
+            for i, member in enumerate(self.endpoints):
+                self.nets.setdefault(self.find(i), []).append(member)
+
+        return self.nets
+
+    # Lists of rails that are on the same net. rails defaults to every pin-less
+    # junction device.
+    def shorts(self, rails=None):
+        if rails is None:
+            rails = [(name, None) for name, device in self.doc.devices.items() if not device.pins and (name, None) in self.ids]
+
+        by_net = {}
+
+        for rail in rails:
+            by_net.setdefault(self.find(self.id(rail)), []).append(rail)
+
+        return [rails_on_net for rails_on_net in by_net.values() if len(rails_on_net) > 1]
+
+    # The connected nets, named after their junction device where they have one
+    def netlist(self):
+        result = []
+
+        for members in self.get_nets().values():
+            if len(members) < 2:
+                continue
+
+            junctions = [device for device, pin in members if pin is None]
+            result.append({
+                "name": junctions[0] if junctions else format_endpoint(members[0]),
+                "endpoints": [format_endpoint(member) for member in members],
+            })
+
+        return result
+
+# The harness flattened into one row per wire, with devices, endpoints, colors
+# and groups stored as integer codes in flat arrays so counts can be done in
+# bulk (with numpy if it is installed). Endpoint codes are -1 for a connection
+# end without pins.
+class WireTable:
+    def __init__(self, doc):
+        self.devices = list(doc.devices)
+        self.endpoints = [] # (device name, pin) for each endpoint code
+        self.colors = []
+        self.groups = list(doc.groups)
+
+        device_codes = {name: i for i, name in enumerate(self.devices)}
+        endpoint_codes = {}
+        color_codes = {} # map from color as written to its code
+        name_codes = {} # map from color code (as in self.colors) to its index
+
+        self.from_device = array('q')
+        self.from_pin = array('q')
+        self.to_device = array('q')
+        self.to_pin = array('q')
+        self.color = array('q')
+        self.group = array('q')
+
+        def endpoint_code(endpoint):
+            code = endpoint_codes.get(endpoint)
+
+            if code is None:
+                code = endpoint_codes[endpoint] = len(self.endpoints)
+                self.endpoints.append(endpoint)
+
+            return code
+
+        def color_code(color):
+            code = color_codes.get(color)
+
+            if code is None:
+                # long (deprecated) names are counted with their color code
+                name = doc.color_registry.code(color)
+                code = name_codes.get(name)
+
+                if code is None:
+                    code = name_codes[name] = len(self.colors)
+                    self.colors.append(name)
+
+                color_codes[color] = code
+
+            return code
+
+        for group_code, connections in enumerate(doc.groups.values()):
+            for c in connections:
+                fromDevice = device_codes[c.fromDevice]
+                toDevice = device_codes[c.toDevice]
+
+                for i in range(c.wire_count()):
+                    self.from_device.append(fromDevice)
+                    self.from_pin.append(endpoint_code((c.fromDevice, str(c.fromPins[i]))) if i < len(c.fromPins) else -1)
+                    self.to_device.append(toDevice)
+                    self.to_pin.append(endpoint_code((c.toDevice, str(c.toPins[i]))) if i < len(c.toPins) else -1)
+                    self.color.append(color_code(str(c.colors[i])) if i < len(c.colors) else color_code(""))
+                    self.group.append(group_code)
+
+    def __len__(self):
+        return len(self.color)
+
+    # Number of wires per color code
+    def color_counts(self):
+        return dict(zip(self.colors, count_codes(self.color, len(self.colors))))
+
+    def group_counts(self):
+        return dict(zip(self.groups, count_codes(self.group, len(self.groups))))
+
+    # Number of wires on each (device, pin) endpoint
+    def pin_counts(self):
+        if numpy is not None:
+            codes = numpy.concatenate((numpy.frombuffer(self.from_pin, dtype=numpy.int64), numpy.frombuffer(self.to_pin, dtype=numpy.int64)))
+            counts = numpy.bincount(codes[codes >= 0], minlength=len(self.endpoints)).tolist()
+        else:
+            counter = Counter(chain(self.from_pin, self.to_pin))
+            counts = [counter[code] for code in range(len(self.endpoints))]
+
+        return dict(zip(self.endpoints, counts))
+
+    # Wire counts by (from device, to device, color), ordered by the integer codes:
+    # devices in the order of doc.devices and colors in the order they first
+    # appear in the connections
+    def bom(self):
+        if numpy is not None and len(self) > 0:
+            devices = len(self.devices)
+            colors = len(self.colors)
+            keys = (numpy.frombuffer(self.from_device, dtype=numpy.int64) * devices + numpy.frombuffer(self.to_device, dtype=numpy.int64)) * colors + numpy.frombuffer(self.color, dtype=numpy.int64)
+            keys, counts = numpy.unique(keys, return_counts=True)
+            rows = [((key // colors) // devices, (key // colors) % devices, key % colors, count) for key, count in zip(keys.tolist(), counts.tolist())]
+        else:
+            rows = [(*key, count) for key, count in sorted(Counter(zip(self.from_device, self.to_device, self.color)).items())]
+
+        return [(self.devices[a], self.devices[b], self.colors[color], count) for a, b, color, count in rows]
+
+# Count how often each code from 0 to n - 1 occurs in column
+def count_codes(column, n):
+    if numpy is not None:
+        return numpy.bincount(numpy.frombuffer(column, dtype=numpy.int64), minlength=n).tolist()
+
+    counter = Counter(column)
+    return [counter[code] for code in range(n)]
+
+# Write the wire counts of each input file's WireTable, as JSON if path ends in
+# .json and as CSV otherwise (- for CSV on stdout). The file name is only
+# included when there is more than one input file.
+def write_bom(path, tables, out):
+    if path.lower().endswith(".json"):
+        data = {}
+
+        for input_file, table in tables.items():
+            data[input_file] = {
+                "wires": len(table),
+                "colors": table.color_counts(),
+                "groups": table.group_counts(),
+                "pins": [{"device": device, "pin": pin, "wires": count} for (device, pin), count in table.pin_counts().items()],
+                "cables": [{"from": a, "to": b, "color": color, "count": count} for a, b, color, count in table.bom()],
+            }
+
+        write_json(path, data if len(tables) > 1 else next(iter(data.values())), out)
+        return
+
+    f = out if path == "-" else open(path, 'w', newline='')
+
+    try:
+        writer = csv.writer(f)
+        file_column = ["file"] if len(tables) > 1 else []
+        writer.writerow(file_column + ["from", "to", "color", "count"])
+
+        for input_file, table in tables.items():
+            for row in table.bom():
+                writer.writerow(([input_file] if file_column else []) + list(row))
+    finally:
+        if f is not out:
+            f.close()
+
+# Color lookup tables built once from color_list (plus any colors from the
+# YAML file), so resolving a wire color is a dict lookup.
+class ColorRegistry:
+    def __init__(self, colors=color_list):
+        self.hex = {} # map from color code to hex value
+        self.codes = {} # map from long (deprecated) color name to color code
+        self.edges = {} # map from code or name to the edge color string
+
+        for code, name, hex_value in colors:
+            self.add(code, name, hex_value)
+
+    def add(self, code, name, hex_value):
+        self.hex[code] = hex_value
+        self.edges[code] = '#000000:' + hex_value + ':#000000'
+
+        if name:
+            self.codes[name] = code
+            self.edges.pop(name, None)
+
+    # Add the colors from the "colors" section of a YAML file. Each entry is either
+    # a string "code, name, hex" or a mapping with code, name (optional) and hex.
+    # Returns the entries that couldn't be understood.
+    def load(self, yaml):
+        invalid = []
+
+        for entry in yaml:
+            if type(entry) == str:
+                fields = [x.strip().strip('"\'') for x in entry.split(",")]
+
+                if len(fields) == 2:
+                    fields.insert(1, "")
+            elif type(entry) == dict:
+                fields = [entry.get("code"), entry.get("name", ""), entry.get("hex")]
+            else:
+                fields = []
+
+            if len(fields) != 3 or not all(type(x) == str for x in fields) or not fields[0] or not fields[2]:
+                invalid.append(entry)
+                continue
+
+            self.add(*fields)
+
+        return invalid
+
+    def valid(self, code):
+        return code in self.hex or code in self.codes
+
+    def deprecated(self, code):
+        return code not in self.hex and code in self.codes
+
+    # The color code for a code or long name (unknown colors are returned as they are)
+    def code(self, color):
+        return color if color in self.hex else self.codes.get(color, color)
+
+    # Hex value of a color code or long name, black if it is unknown. Problems with
+    # colors are reported by Doc, so this doesn't warn.
+    def get(self, code):
+        hex_value = self.hex.get(code)
+
+        if hex_value is not None:
+            return hex_value
+
+        if code in self.codes:
+            return self.hex[self.codes[code]]
+
+        return self.hex.get("BK", "#000000")
+
+    # Edge color for a wire: the color with a black outline on each side
+    def edge(self, code):
+        edge = self.edges.get(code)
+
+        if edge is None:
+            edge = '#000000:' + self.get(code) + ':#000000'
+            self.edges[code] = edge
+
+        return edge
+
+default_colors = ColorRegistry()
+
+def get_color(code):
+    return default_colors.get(code)
 
 def valid_color(code):
-    return (code in [c[0] for c in color_list]) or (code in [c[1] for c in color_list])
+    return default_colors.valid(code)
 
 if __name__ == '__main__':
     main()